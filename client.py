@@ -4,6 +4,7 @@
 # import the network interface library
 from takumi_connection import Client
 from takumi_connection import Connection
+from takumi_connection import create_client_ssl_context
 from threading import Thread
 #import curses
 import os
@@ -11,6 +12,7 @@ import platform
 import struct
 import sys
 import random
+import time
 
 # if the operating system is Windows, make it compatible with terminal color
 # display.
@@ -83,9 +85,14 @@ def blank_current_readline():
         sys.stdout.write('\x1b[1A\x1b[2K'*(text_len//cols)) # Move cursor up and clear line
         sys.stdout.write('\x1b[0G')                         # Move to start of line
 
+# reconnect every this many seconds after the connection was lost, until the
+# server comes back or the attempts run out.
+RECONNECT_INTERVAL = 1
+RECONNECT_ATTEMPTS = 30
+
 class ChatClient:
-    def __init__(self, host, port):
-        self.client = Client(host, port)
+    def __init__(self, host, port, ssl_context=None):
+        self.client = Client(host, port, ssl_context=ssl_context)
         self.is_running = False
         self.is_authenticated = False
         self.chat_input_worker = None
@@ -96,13 +103,29 @@ class ChatClient:
         self.date_time_profile = ['red', 'green', 'yellow', 'blue', 'magenda',
                                   'cyan', 'white']
 
+        # the members of the current room, received in pages then kept up to
+        # date with the deltas.
+        self.roster = dict()    # (lowercase username, username)
+        self.roster_version = -1
+        self.roster_page_count = 0
+
+        # the token to rejoin the room after the connection was lost.
+        self.roomid = None
+        self.resume_token = None
+
     def add_user_color(self, username):
         self.user_color[username] = random.sample(self.color_profile, 1)[0]
         self.user_datetime_color[username] = self.user_color[username][2:]
 
     def server_handler(self, recv, conn):
 
-        if recv[0] == 'auth':
+        if recv[0] == 'auth' and self.resume_token is not None:
+            # rejoin the previous room, the token is used only once so that
+            # the user is asked to sign in if it doesn't work.
+            conn.send_multiple(['resume', self.roomid, self.resume_token])
+            self.resume_token = None
+
+        elif recv[0] == 'auth':
             # ask user the username and preferred room id.
             print()
             print(ansi_color("magenda", ansi_color("bold", 'Username')),
@@ -139,22 +162,28 @@ class ChatClient:
             self.user = recv[1]
             self.roomid = recv[2]
 
+            # the members will be sent in the following `roster_page`.
+            self.roster = dict()
+            self.roster_version = int(recv[3])
+            self.roster_page_count = int(recv[5])
+            self.resume_token = recv[6]
+
 		    #value = "".join(["\033[", num, "m", s, "\033[0m"])
             print('\033[1m', end='')    # start of the bold text
             print(f'=============================================')
             print(f'Welcome {recv[1]} to Takumi Messenger!')
             print('You are in Room ID', recv[2])
-            print('Current active members:')
-            if len(recv[3:]):
-                for mem in recv[3:]:
-                    print('\t-', mem)
-            else:
+            print(f'Current active members: {recv[4]}')
+            if self.roster_page_count == 0:
                 print('\t--- There\'s no member yet. ---')
             print('\033[0m', end='')
 
             print(ansi_color('red',
                              ansi_color('bold',
                                         '\nTo quit the chat, type "\\quit"')))
+            print(ansi_color('red',
+                             ansi_color('bold',
+                                        'To search the chat, type "\\search [-p page no] [words]"')))
 
             print('\033[1m', end='')
             print(f'=============================================\n')
@@ -163,10 +192,44 @@ class ChatClient:
             self.is_authenticated = True
             self.conn = conn
 
-            # redirect to the chat management system.
-            self.chat_input_worker = Thread(target=self.chat_input,
-                                            args=())
-            self.chat_input_worker.start()
+            # redirect to the chat management system, which is still running
+            # if the session was resumed.
+            if self.chat_input_worker is None or not self.chat_input_worker.is_alive():
+                self.chat_input_worker = Thread(target=self.chat_input,
+                                                args=())
+                self.chat_input_worker.start()
+
+        elif recv[0] == 'roster_page':
+            # a page sent before any newer delta, just add the members.
+            for mem in recv[3:]:
+                self.roster[mem.lower()] = mem
+
+            # print the members once the last page has arrived.
+            if int(recv[2]) == self.roster_page_count:
+                if platform.system() != 'Windows':
+                    blank_current_readline()
+
+                print('\033[1m', end='')
+                for mem in self.roster.values():
+                    print('\t-', mem)
+                print('\033[0m', end='')
+
+                if platform.system() != 'Windows':
+                    sys.stdout.write(ansi_color('red', '> ')+ readline.get_line_buffer())
+                    sys.stdout.flush()
+
+        elif recv[0] == 'roster_delta':
+            # the older deltas are already included in the received roster.
+            # the following parts of a delta have the version just applied.
+            if int(recv[1]) > self.roster_version or\
+                    (int(recv[1]) == self.roster_version and int(recv[2]) > 1):
+                self.roster_version = int(recv[1])
+
+                for change in recv[4:]:
+                    if change[0] == '+':
+                        self.roster[change[1:].lower()] = change[1:]
+                    else:
+                        self.roster.pop(change[1:].lower(), None)
 
         elif recv[0] == 'msg_out':
 
@@ -194,6 +257,32 @@ class ChatClient:
 
             conn.send('empty_res')
 
+        elif recv[0] == 'search_res':
+            if platform.system() != 'Windows':
+                blank_current_readline()
+
+            print()
+            print(ansi_color('bold', f'Search results: {recv[3]} messages, '
+                                     f'page {recv[1]} of {recv[2]}'))
+
+            # each message is sent as (username, date, content)
+            for i in range(4, len(recv) - 2, 3):
+                if recv[i] not in self.user_color:
+                    self.add_user_color(recv[i])
+
+                print(ansi_color("bold",
+                                 ansi_color(self.user_color[recv[i]],
+                                            f'  {recv[i]}  ')),
+                      recv[i + 2],
+                      ansi_color("italic",
+                                 ansi_color(self.user_datetime_color[recv[i]],
+                                            ''.join(["  - ", recv[i + 1]]))))
+            print()
+
+            if platform.system() != 'Windows':
+                sys.stdout.write(ansi_color('red', '> ')+ readline.get_line_buffer())
+                sys.stdout.flush()
+
         elif recv[0] == 'quit':
             self.is_running = False
             self.is_authenticated = False
@@ -211,12 +300,36 @@ class ChatClient:
 
             # clear the previous line of input
             sys.stdout.write('\033[1A\x1b[2K')
+
+            # the user wants to leave, so don't reconnect after that.
+            if user_input == '\\quit':
+                self.is_running = False
+
             self.conn.send_multiple(['msg_in', user_input])
 
     def run(self):
         self.is_running = True
         self.client.set_response_handler(self.server_handler)
-        self.client.run()
+
+        attempts = 0
+        while self.is_running:
+            try:
+                self.client.run()
+                attempts = 0
+            except Exception:
+                # the server has never been reached, or it doesn't come back.
+                attempts += 1
+                if self.resume_token is None or attempts > RECONNECT_ATTEMPTS:
+                    raise
+
+            # the connection was lost without quitting, rejoin the room with
+            # the resume token.
+            if not self.is_running or self.resume_token is None:
+                break
+
+            if attempts == 0:
+                print(ansi_color('red', 'The connection was lost, reconnecting...'))
+            time.sleep(RECONNECT_INTERVAL)
 
     def __del__(self):
         if self.is_running:
@@ -228,5 +341,11 @@ if __name__ == '__main__':
     host = '127.0.0.1'
     port = 9999
 
-    chat_client = ChatClient(host, port)
+    # usage: client.py [CA certificate file]
+    # connect over TLS when the certificate of the server is given.
+    ssl_context = None
+    if len(sys.argv) > 1:
+        ssl_context = create_client_ssl_context(sys.argv[1])
+
+    chat_client = ChatClient(host, port, ssl_context=ssl_context)
     chat_client.run()
@@ -2,10 +2,25 @@
 # server.py
 
 # import the network interface library
+from takumi_connection import Client
 from takumi_connection import Connection
 from takumi_connection import Server
+from takumi_connection import create_client_ssl_context
+from takumi_connection import create_server_ssl_context
+from collections import deque
 from datetime import datetime
+from threading import Lock
+from threading import RLock
+from threading import Thread
+import argparse
+import hmac
+import math
+import os
 import random
+import re
+import secrets
+import struct
+import time
 
 '''
 protocol guideline:
@@ -17,11 +32,26 @@ protocol guideline:
   - conn.accept_msg - the client has just connected to the server.
                       server must response with `auth`.
   - `auth` - server want the user information from client
+             the connection is closed if the client hasn't joined a room
+             within AUTH_TIMEOUT seconds.
   - `auth_res [username] [room id | none]` - client response for the need of
                                              user info.
-  - `let_in [username] [room id] [room member 1] [room member 2] ...`
+  - `resume [room id] [resume token]` - client response for `auth`, to rejoin
+                                        the room it was in without signing in.
+  - `let_in [username] [room id] [roster version] [member count] [page count] [resume token]`
         server allow the current user to enter the existing (or a new) chat
-        room, and tell the client the chat room informanion.
+        room, and tell the client the chat room informanion. the current
+        members are sent afterwards in `page count` of `roster_page`.
+        the token can be used with `resume` after the connection was lost.
+  - `roster_page [roster version] [page no] [room member 1] [room member 2] ...`
+        a part of the member list of the room, at the given roster version.
+        page no starts from 1.
+  - `roster_delta [roster version] [part no] [part count] [+username|-username] ...`
+        server send the membership changes since the previous delta, `+` for
+        the members who are now in the room and `-` for those who are not.
+        a large delta is split into `part count` frames of the same version,
+        part no starts from 1. client should ignore the delta which isn't
+        newer than its roster, and apply every part of the newer one.
   - `empty_res` - client send a response without any information. (happened most
                     of the time when there's really nothing to send to the
                     server, and server might send this as well)
@@ -34,28 +64,189 @@ protocol guideline:
             note: server will `msg_out` the same message sent by the client as
             well, to confirm the integrity and the message arrival time on the
             server.
+  - `search_res [page no] [page count] [result count] [username] [date] [message content] ...`
+        the result of `\\search`, the best matches come first. a message
+        is sent as three arguments, and there are up to SEARCH_PAGE_SIZE
+        messages in a page. the result count ends with `+`, e.g. `200+`,
+        when the search has stopped before looking at every match.
   - `quit` - quit the session. (close the connection)
     - any sides can send it, for some reasons.
 
 chat room id: consists of 4 random digits, stored as a string.
+
+federation: several servers (nodes) can share their chat rooms. each node
+knows the (host, port) of every node, and a room is owned by node
+`room id % node count`. every pair of nodes is linked by a single connection,
+opened by the node with the higher id, which carries the messages of all rooms.
+- `peer_hello [node id] [federation key]` - sent instead of `auth_res` by the
+                                            node which opens the link.
+        the key is a shared secret of every node, which is sent in plaintext
+        unless the nodes are served over TLS.
+- `fed_join [room id] [username]` - ask the owner to let a user in.
+- `fed_join_res [room id] [username] [ok | reason]` - the owner's answer.
+- `fed_roster [room id] [page no] [page count] [node id:username] ...`
+        the owner sends the members of the room to the node which is about
+        to have its first member in the room.
+- `fed_member [room id] [+|-] [node id] [username]` - a member joined or left.
+        the node tells the owner about its own members, then the owner tells
+        the other nodes which have members in the room.
+- `fed_msg [room id] [username] [message content] [date]`
+        a message in the room, sent once per node. the owner relays it to the
+        other nodes which have members in the room.
 '''
 
+# the maximum bytes of member names in a single roster frame. a large roster
+# is sent in pages of this size, so that no frame gets near MAX_FRAME_BYTES
+# however many members a room has.
+ROSTER_FRAME_BYTES = 1536
+
+# joins and leaves of a room are merged, then sent out once every this many
+# seconds.
+PRESENCE_INTERVAL = 0.5
+
+# the seconds to wait before opening a lost link to the other node again.
+PEER_RETRY_INTERVAL = 1
+
+# the seconds between two snapshots of the rooms and the sessions.
+SNAPSHOT_INTERVAL = 10
+
+# a session can be resumed within this many seconds after its connection was
+# lost, the expired sessions are looked for every SESSION_CHECK_INTERVAL.
+SESSION_TTL = 60 * 60
+SESSION_CHECK_INTERVAL = 60
+
+# the random room ids tried before looking through every id of this node.
+ROOM_ID_ATTEMPTS = 100
+
+# the seconds a client has to join a room (or a node to open its link) after
+# connecting, until then its connection is counted as pending by the server.
+AUTH_TIMEOUT = 30
+
+# the messages of each room kept for `\search`, the older ones are evicted.
+SEARCH_MAX_MESSAGES = 200000
+SEARCH_MAX_AGE = 24 * 60 * 60
+# the messages sent are indexed in the background every this many seconds.
+SEARCH_INDEX_INTERVAL = 0.1
+# a query looks at this many of the latest messages with its rarest word at
+# most, and ranks this many of the latest matches at most, so that its time
+# doesn't grow with the size of the room.
+SEARCH_MAX_SCAN = 5000
+SEARCH_MAX_RESULTS = 200
+SEARCH_PAGE_SIZE = 10
+# the length of the message content in the result.
+SEARCH_SNIPPET_LENGTH = 200
+
+# snapshot file: the header, the index of the rooms, then the members of each
+# room. every number is little-endian.
+SNAPSHOT_MAGIC = b'TKSS'
+SNAPSHOT_VERSION = 2
+SNAPSHOT_HEADER = struct.Struct('<4sHId')    # magic, version, room count, saved time
+SNAPSHOT_INDEX = struct.Struct('<4sII')      # room id, offset, length
+SNAPSHOT_MEMBER = struct.Struct('<16sdH')    # resume token, last seen time, name length
+
 class ChatServer:
-    def __init__(self, host, port, is_prompt=False):
-        self.server = Server(host, port, is_prompt)
+    def __init__(self, host, port, is_prompt=False, ssl_context=None,
+                 node_id=0, nodes=None, federation_key='', peer_ssl_context=None,
+                 admin_port=None, snapshot_path=None,
+                 snapshot_interval=SNAPSHOT_INTERVAL, session_ttl=SESSION_TTL,
+                 backlog=128,
+                 max_connections=None, max_per_ip=None, auth_timeout=AUTH_TIMEOUT):
+        self.server = Server(host, port, is_prompt, ssl_context=ssl_context,
+                             admin_port=admin_port, backlog=backlog,
+                             max_connections=max_connections,
+                             max_per_ip=max_per_ip, auth_timeout=auth_timeout)
+        self.server.add_admin_command('rooms', self.admin_rooms,
+                                      'rooms [n] - the biggest chat rooms')
+        # the commands timed apart by the admin console.
+        self.server.command_timer.add_commands([
+            '200: Success', 'auth_res', 'resume', 'peer_hello', 'msg_in', 'quit',
+            'empty_res', 'fed_join', 'fed_join_res', 'fed_roster', 'fed_member',
+            'fed_msg'])
         # a dict which stores `Connection` instances of clients.
         self.chatrooms = dict() # (chat room id, ChatRoom instance)
         self.authorized_user = dict() # (sock addr, User instance)
 
+        # federation info. `nodes` lists (host, port) of every node, including
+        # this one, and the index in the list is the node id. every node must
+        # be given the same list.
+        self.node_id = node_id
+        self.nodes = nodes or [(host, port)]
+        self.federation_key = federation_key
+
+        # the key is the only thing which tells the nodes from the clients.
+        if len(self.nodes) > 1 and not federation_key:
+            raise Exception('The federation of several nodes requires a federation key.')
+        self.peer_ssl_context = peer_ssl_context
+
+        self.peer_links = dict() # (node id, Connection instance)
+        self.peer_nodes = dict() # (sock addr, node id) of the accepted links
+        # the users waiting for the owner node to accept them.
+        self.pending_joins = dict() # ((room id, lowercase name), (Connection instance, resume token))
+
+        # every user who has joined a room and hasn't quit yet, including the
+        # ones whose connection was lost, so that they can resume.
+        self.sessions = dict() # (resume token, (room id, username, last seen time))
+        self.session_users = dict() # (resume token, ChatUser instance)
+        self.session_ttl = session_ttl
+
+        # the snapshot of the rooms and the sessions, the rooms in the loaded
+        # snapshot are restored only when they are used.
+        self.snapshot_path = snapshot_path
+        self.snapshot_interval = snapshot_interval
+        self.snapshot_data = b''
+        self.snapshot_index = dict() # (room id, (offset, length))
+        self.snapshot_dirty = False
+
         self.is_running = False
 
+    def admin_rooms(self, args):
+        count = int(args[0]) if args else 10
+        chatRooms = sorted(self.chatrooms.values(), key=lambda room: len(room.usernames),
+                           reverse=True)[:count]
+
+        lines = ['%-8s %6s %8s %8s %10s' % ('room id', 'owner', 'members',
+                                             'local', 'queued')]
+        for chatRoom in chatRooms:
+            # the messages waiting to be sent to the local members.
+            queued = sum(len(chatRoom.users[x].conn.awaited_data) for x in list(chatRoom.users))
+            lines.append('%-8s %6d %8d %8d %10d' % (chatRoom.id, self.owner_of(chatRoom.id),
+                                                    len(chatRoom.usernames),
+                                                    len(chatRoom.users), queued))
+        lines.append(f'{len(self.chatrooms)} rooms, {len(self.authorized_user)} users in total.')
+        return '\n'.join(lines)
+
+    # rooms are spread over the nodes by their id, so every node knows which
+    # node owns a room without asking.
+    def owner_of(self, room_id):
+        return int(room_id) % len(self.nodes)
+
+    def allocate_room_id(self):
+        # returns None if every room id of this node is taken.
+        def is_free(room_id):
+            # the rooms in the snapshot are still taken.
+            return room_id not in self.chatrooms and room_id not in self.snapshot_index
+
+        for _ in range(ROOM_ID_ATTEMPTS):
+            room_id = str(random.randrange(self.node_id, 10000, len(self.nodes))).zfill(4)
+            if is_free(room_id):
+                return room_id
+
+        # most ids are taken, so look through all of them.
+        for room_id in range(self.node_id, 10000, len(self.nodes)):
+            if is_free(str(room_id).zfill(4)):
+                return str(room_id).zfill(4)
+
+        return None
+
     def client_handler(self, recv, conn):
         # notice: every cases must send a message in some ways.
 
         is_valid = True # flag to specify the validity of arguments.
         invalid_msg = '' # if args are invalid, why.
 
-        if recv[0] == conn.accept_msg:  # the client has just connected.
+        if conn.addr in self.peer_nodes:    # the message from the other node.
+            self.federation_handler(recv, conn, self.peer_nodes[conn.addr])
+        elif recv[0] == conn.accept_msg:  # the client has just connected.
             conn.send('auth')
         elif recv[0] == 'auth_res':     # the client send user info to server.
             # check if the info is in the valid form.
@@ -65,47 +256,46 @@ class ChatServer:
                     (recv[2].isnumeric() or recv[2] == 'none') and\
                     len(recv[2]) == 4:
 
-                chatRoom = None
-                # check the availabitily of chat room.
-                if recv[2] == 'none':
-                    # in case user didn't pick up a room id, create a chat room.
-                    chatRoom = ChatRoom()
-                elif recv[2] not in self.chatrooms:
-                    # user put a valid chat room id, but not exist.
-                    invalid_msg = 'The Room ID you specified does not exist.'
-                    is_valid = False
-                else:
-                    # that room exists.
-                    chatRoom = self.chatrooms[recv[2]]
-
-                # check if this username already exists in that chatroom.
-                if recv[1].lower() in chatRoom.usernames:
-                    is_valid = False
-                    invalid_msg = f'The name "{recv[1]}" already exists in the room with ID {recv[2]}'
+                invalid_msg = self.join_room(recv[1], recv[2], conn)
+                is_valid = invalid_msg == ''
 
-                # if room id is valid.
-                if is_valid:
-                    # create a ChatUser instance
-                    newUser = ChatUser(recv[1], chatRoom, conn)
-
-                    # get the current members of that room.
-                    chatRoomCurrMember = [chatRoom.users[x].name for x in chatRoom.users]
+            # some arguments are incorrect.
+            else:
+                is_valid = False
+                invalid_msg = 'Either username or room ID is invalid.'
 
-                    self.authorized_user[conn.addr] = newUser
+        elif recv[0] == 'resume':
+            # the client rejoins its room with the token given in `let_in`.
+            # resume [room id] [resume token]
+            if len(recv) == 3 and recv[1].isnumeric() and len(recv[1]) == 4:
+                self.restore_room(recv[1])
 
-                    # sending room info to users
-                    conn.send_multiple(['let_in', recv[1], chatRoom.id,
-                                        *chatRoomCurrMember])
-                    #
-                    # put the user to the chat room.
-                    chatRoom.add_user(newUser)
-                    self.chatrooms[chatRoom.id] = chatRoom
+            session = self.sessions.get(recv[2]) if len(recv) == 3 else None
+            if session is None or session[0] != recv[1]:
+                is_valid = False
+                invalid_msg = 'The session has expired, please sign in again.'
+            else:
+                # the user whose connection was lost is replaced.
+                if recv[2] in self.session_users:
+                    self.remove_user(self.session_users[recv[2]], end_session=False)
 
+                invalid_msg = self.join_room(session[1], session[0], conn, recv[2])
+                is_valid = invalid_msg == ''
 
-            # some arguments are incorrect.
+        elif recv[0] == 'peer_hello':
+            # the other node of the federation opens a link.
+            # peer_hello [node id] [federation key]
+            # the users who have signed in can't become a node.
+            if len(recv) == 3 and recv[1].isnumeric() and\
+                    int(recv[1]) < len(self.nodes) and int(recv[1]) != self.node_id and\
+                    self.federation_key and conn.addr not in self.authorized_user and\
+                    hmac.compare_digest(recv[2], self.federation_key):
+                self.add_peer_link(int(recv[1]), conn)
+                self.peer_nodes[conn.addr] = int(recv[1])
+                conn.establish()
             else:
                 is_valid = False
-                invalid_msg = 'Either username or room ID is invalid.'
+                invalid_msg = 'The node is not a part of this federation.'
 
         elif recv[0] == 'msg_in':
             # check the incoming message first
@@ -114,23 +304,44 @@ class ChatServer:
             elif recv[1][0] == '\\':
                 if recv[1][1:] == 'quit':
                     # user want to disconnect
-                    self.authorized_user[conn.addr].room.remove_user(self.authorized_user[conn.addr])
+                    self.remove_user(self.authorized_user[conn.addr])
                     conn.stop()
 
+                elif recv[1][1:].split(' ')[0] == 'search':
+                    # \search [-p page no] [words] ...
+                    args = recv[1][1:].split()[1:]
+                    page = 1
+                    if len(args) > 1 and args[0] == '-p' and args[1].isnumeric():
+                        page = max(int(args[1]), 1)
+                        args = args[2:]
+
+                    if not args:
+                        is_valid = False
+                        invalid_msg = 'Usage: \\search [-p page no] [words] ...'
+                    else:
+                        chatRoom = self.authorized_user[conn.addr].room
+                        results, match_count, is_partial =\
+                                chatRoom.search(' '.join(args), page)
+
+                        page_count = math.ceil(match_count / SEARCH_PAGE_SIZE)
+                        total = f'{match_count}+' if is_partial else str(match_count)
+                        conn.send_multiple(['search_res', str(page), str(page_count),
+                                            total, *[part for result in results
+                                                     for part in result]])
+
                 # not a supported command.
                 else:
                     is_valid = False
                     invalid_msg = f'Unknown command {recv[1][1:]}'
 
             else:
-                self.authorized_user[conn.addr].room.broadcast('msg_out',
-                                                               self.authorized_user[conn.addr].name,
-                                                               recv[1],
-                                                               datetime.now().strftime("%m/%d/%Y, %H:%M:%S"))
+                chatUser = self.authorized_user[conn.addr]
+                self.relay_message(chatUser.room, self.node_id, chatUser.name,
+                                   recv[1], datetime.now().strftime("%m/%d/%Y, %H:%M:%S"))
 
         elif recv[0] == 'quit':
             if conn.addr in self.authorized_user:
-                self.authorized_user[conn.addr].room.remove_user(self.authorized_user[conn.addr])
+                self.remove_user(self.authorized_user[conn.addr])
 
             conn.stop()
 
@@ -141,48 +352,803 @@ class ChatServer:
         if not(is_valid):
             conn.send_multiple(['stat_update', 'WARNING', invalid_msg])
 
+    def join_room(self, name, room_id, conn, token=None):
+        # returns why the user can't join the room, or '' if the user has
+        # joined or is waiting for the owner node to accept.
+        chatRoom = None
+        # the room might be only in the snapshot so far, including the room
+        # owned by the other node, whose sessions are kept by this node.
+        if room_id != 'none':
+            self.restore_room(room_id)
+
+        # check the availabitily of chat room.
+        if room_id == 'none':
+            # in case user didn't pick up a room id, create a chat room.
+            room_id = self.allocate_room_id()
+            if room_id is None:
+                return 'No room ID is available, please join an existing room.'
+
+            chatRoom = ChatRoom(room_id)
+        elif self.owner_of(room_id) != self.node_id:
+            # the room is owned by the other node, which has to accept
+            # the user first.
+            if (room_id, name.lower()) in self.pending_joins or\
+                    room_id in self.chatrooms and\
+                    name.lower() in self.chatrooms[room_id].usernames:
+                return f'The name "{name}" already exists in the room with ID {room_id}'
+            if not self.send_to_node(self.owner_of(room_id),
+                                     ['fed_join', room_id, name]):
+                return 'The server hosting this room can\'t be reached.'
+
+            self.pending_joins[(room_id, name.lower())] = (conn, token)
+            return ''
+        else:
+            if room_id not in self.chatrooms:
+                # user put a valid chat room id, but not exist.
+                return 'The Room ID you specified does not exist.'
+
+            # that room exists.
+            chatRoom = self.chatrooms[room_id]
+
+        # check if this username already exists in that chatroom.
+        if name.lower() in chatRoom.usernames:
+            return f'The name "{name}" already exists in the room with ID {chatRoom.id}'
+
+        self.chatrooms[chatRoom.id] = chatRoom
+        self.admit_user(name, chatRoom, conn, token)
+        return ''
+
+    def admit_user(self, name, chatRoom, conn, token=None, announce=True):
+        # create a ChatUser instance, with a new session if it's not resumed.
+        newUser = ChatUser(name, chatRoom, conn, token or secrets.token_hex(16))
+
+        self.authorized_user[conn.addr] = newUser
+        conn.establish()
+        self.sessions[newUser.token] = (chatRoom.id, name, time.time())
+        self.session_users[newUser.token] = newUser
+        self.snapshot_dirty = True
+
+        with chatRoom.presence_lock:
+            # sending room info and the current members in pages,
+            # then put the user to the chat room.
+            chatRoom.let_in(newUser)
+            if announce:
+                self.announce_member(chatRoom, '+', self.node_id, name)
+
+    def remove_user(self, chatUser, end_session=True):
+        chatRoom = chatUser.room
+
+        self.authorized_user.pop(chatUser.conn.addr, None)
+        self.session_users.pop(chatUser.token, None)
+        if end_session:
+            self.sessions.pop(chatUser.token, None)
+            self.snapshot_dirty = True
+
+        with chatRoom.presence_lock:
+            chatRoom.remove_user(chatUser)
+            self.announce_member(chatRoom, '-', self.node_id, chatUser.name)
+            self.drop_room_copy(chatRoom.id)
+
+    def drop_room_copy(self, room_id):
+        # the copy of the room owned by the other node is kept only while
+        # it has some local members, or some users are about to join.
+        chatRoom = self.chatrooms.get(room_id)
+        if chatRoom is None or self.owner_of(room_id) == self.node_id:
+            return
+
+        if not chatRoom.users and\
+                not any(pending_id == room_id for pending_id, name in self.pending_joins):
+            self.chatrooms.pop(room_id, None)
+
+    # ======= federation =======
+
+    def send_to_node(self, node, msg):
+        link = self.peer_links.get(node)
+        if link is None or not link.is_running:
+            return False
+
+        link.send_multiple(msg)
+        return True
+
+    def announce_member(self, chatRoom, change, node, name):
+        # the owner tells every other node with members in the room, except
+        # the node of that member. the others only tell the owner.
+        msg = ['fed_member', chatRoom.id, change, str(node), name]
+        if self.owner_of(chatRoom.id) == self.node_id:
+            for member_node in chatRoom.member_nodes() - {node}:
+                self.send_to_node(member_node, msg)
+        elif node == self.node_id:
+            self.send_to_node(self.owner_of(chatRoom.id), msg)
+
+    def relay_message(self, chatRoom, origin, name, content, date):
+        chatRoom.broadcast('msg_out', name, content, date)
+
+        # the message is sent only once to each node, which then broadcasts
+        # it to its own members. the owner relays it to the other nodes.
+        msg = ['fed_msg', chatRoom.id, name, content, date]
+        if self.owner_of(chatRoom.id) == self.node_id:
+            for member_node in chatRoom.member_nodes() - {origin}:
+                self.send_to_node(member_node, msg)
+        elif origin == self.node_id:
+            self.send_to_node(self.owner_of(chatRoom.id), msg)
+
+    def federation_handler(self, recv, conn, node):
+        if recv[0] == 'fed_join':
+            # the other node asks to let its user in a room owned by this node.
+            # fed_join [room id] [username]
+            self.restore_room(recv[1])
+            chatRoom = self.chatrooms.get(recv[1])
+            if chatRoom is None:
+                result = 'The Room ID you specified does not exist.'
+            elif recv[2].lower() in chatRoom.usernames:
+                result = f'The name "{recv[2]}" already exists in the room with ID {recv[1]}'
+            else:
+                result = 'ok'
+
+                with chatRoom.presence_lock:
+                    # the node which has no members yet gets the full roster.
+                    if node not in chatRoom.member_nodes():
+                        members = [f'{self.node_id}:{chatRoom.users[x].name}'
+                                   for x in chatRoom.users] +\
+                                  [f'{member_node}:{name}' for member_node, name
+                                   in chatRoom.remote_users.values()]
+                        pages = split_frames(members)
+                        for page_no, page in enumerate(pages, 1):
+                            conn.send_multiple(['fed_roster', chatRoom.id,
+                                                str(page_no), str(len(pages)), *page])
+
+                    chatRoom.add_remote_user(node, recv[2])
+                    self.announce_member(chatRoom, '+', node, recv[2])
+
+            conn.send_multiple(['fed_join_res', recv[1], recv[2], result])
+
+        elif recv[0] == 'fed_join_res':
+            # fed_join_res [room id] [username] [ok|reason]
+            userConn, token = self.pending_joins.pop((recv[1], recv[2].lower()),
+                                                     (None, None))
+            if userConn is None or not userConn.is_running:
+                # the user has gone while waiting, so let the owner know.
+                if recv[3] == 'ok':
+                    self.send_to_node(node, ['fed_member', recv[1], '-',
+                                             str(self.node_id), recv[2]])
+                self.drop_room_copy(recv[1])
+            elif recv[3] == 'ok':
+                if recv[1] not in self.chatrooms:
+                    self.chatrooms[recv[1]] = ChatRoom(recv[1])
+
+                # the owner has already announced the user.
+                self.admit_user(recv[2], self.chatrooms[recv[1]], userConn,
+                                token, announce=False)
+            else:
+                userConn.send_multiple(['stat_update', 'WARNING', recv[3]])
+                self.drop_room_copy(recv[1])
+
+        elif recv[0] == 'fed_roster':
+            # the members of a room owned by the other node.
+            # fed_roster [room id] [page no] [page count] [node id:username] ...
+            # the owner sends the full roster to a node with no members, so
+            # a copy left without local users is replaced rather than merged.
+            if recv[1] not in self.chatrooms or\
+                    recv[2] == '1' and not self.chatrooms[recv[1]].users:
+                self.chatrooms[recv[1]] = ChatRoom(recv[1])
+
+            chatRoom = self.chatrooms[recv[1]]
+            with chatRoom.presence_lock:
+                for member in recv[4:]:
+                    member_node, name = member.split(':', 1)
+                    chatRoom.add_remote_user(int(member_node), name)
+
+                # nobody here has seen the room yet, so they aren't new members.
+                if not chatRoom.users:
+                    chatRoom.pending_presence = dict()
+
+        elif recv[0] == 'fed_member':
+            # fed_member [room id] [+|-] [node id] [username]
+            chatRoom = self.chatrooms.get(recv[1])
+            if chatRoom is not None:
+                with chatRoom.presence_lock:
+                    if recv[2] == '+':
+                        chatRoom.add_remote_user(int(recv[3]), recv[4])
+                    else:
+                        chatRoom.remove_remote_user(recv[4])
+
+                    self.announce_member(chatRoom, recv[2], int(recv[3]), recv[4])
+
+        elif recv[0] == 'fed_msg':
+            # fed_msg [room id] [username] [message content] [date]
+            chatRoom = self.chatrooms.get(recv[1])
+            if chatRoom is not None:
+                self.relay_message(chatRoom, node, *recv[2:5])
+
+    def peer_handler(self, recv, conn, node):
+        # the messages received on the link this node opened.
+        if recv[0] == 'auth':
+            conn.send_multiple(['peer_hello', str(self.node_id), self.federation_key])
+            self.add_peer_link(node, conn)
+        elif recv[0].startswith('fed_'):
+            self.federation_handler(recv, conn, node)
+
+    def add_peer_link(self, node, conn):
+        # the link replaces the previous one, which must have been lost.
+        if node in self.peer_links:
+            self.peer_lost(node, self.peer_links[node])
+
+        self.peer_links[node] = conn
+
+        if self.server.is_prompt:
+            print(f'The link to node {node} has started.')
+
+    def peer_lost(self, node, conn):
+        if self.peer_links.get(node) is not conn:
+            return
+
+        self.peer_links.pop(node)
+        self.peer_nodes.pop(conn.addr, None)
+
+        if self.server.is_prompt:
+            print(f'The link to node {node} has stopped.')
+
+        for chatRoom in list(self.chatrooms.values()):
+            if self.owner_of(chatRoom.id) == self.node_id:
+                # the members of that node can't be reached anymore.
+                for member_node, name in list(chatRoom.remote_users.values()):
+                    if member_node == node:
+                        with chatRoom.presence_lock:
+                            chatRoom.remove_remote_user(name)
+                            self.announce_member(chatRoom, '-', node, name)
+
+            elif self.owner_of(chatRoom.id) == node:
+                # the room itself is gone, so are its local members.
+                for chatUser in list(chatRoom.users.values()):
+                    chatUser.conn.send_multiple(['stat_update', 'WARNING',
+                                                 'The server hosting this room can\'t be reached.'])
+                    chatUser.conn.send('quit')
+                    self.authorized_user.pop(chatUser.conn.addr, None)
+                    self.session_users.pop(chatUser.token, None)
+
+                self.chatrooms.pop(chatRoom.id, None)
+
+        for room_id, name in list(self.pending_joins):
+            if self.owner_of(room_id) == node:
+                userConn, token = self.pending_joins.pop((room_id, name))
+                userConn.send_multiple(['stat_update', 'WARNING',
+                                        'The server hosting this room can\'t be reached.'])
+                self.drop_room_copy(room_id)
+
+    def peer_dialer(self, node):
+        # keep the link to the node with the lower id open. (the nodes with
+        # the higher id open the links to this node instead)
+        while self.is_running:
+            peer = Client(*self.nodes[node], ssl_context=self.peer_ssl_context)
+            peer.set_response_handler(self.peer_handler, node)
+
+            try:
+                peer.run()
+            except Exception:
+                pass
+
+            if hasattr(peer, 'conn'):
+                self.peer_lost(node, peer.conn)
+
+            time.sleep(PEER_RETRY_INTERVAL)
+
+    # ======= snapshot =======
+
+    def load_snapshot(self):
+        # only the index is read here, the rooms are restored when needed.
+        try:
+            with open(self.snapshot_path, 'rb') as f:
+                data = f.read()
+
+            self.snapshot_index = read_snapshot_index(data)
+            self.snapshot_data = data
+        except (OSError, ValueError, struct.error) as e:
+            if self.server.is_prompt:
+                print(f'The snapshot can\'t be loaded: {e}')
+            return
+
+        if self.server.is_prompt:
+            print(f'The snapshot of {len(self.snapshot_index)} rooms was loaded.')
+
+    def restore_room(self, room_id):
+        entry = self.snapshot_index.pop(room_id, None)
+        if entry is None:
+            return
+
+        # the users of the snapshot can only resume, they aren't in the room
+        # until then.
+        expired = time.time() - self.session_ttl
+        for token, last_seen, name in unpack_snapshot_room(self.snapshot_data, entry[0]):
+            if last_seen >= expired:
+                self.sessions.setdefault(token, (room_id, name, last_seen))
+
+        if self.owner_of(room_id) == self.node_id and room_id not in self.chatrooms:
+            self.chatrooms[room_id] = ChatRoom(room_id)
+
+        self.snapshot_dirty = True
+
+    def save_snapshot(self):
+        # copying the state is the only part which the others have to wait
+        # for, the rest is done on the copy.
+        unrestored = list(self.snapshot_index.items())
+        sessions = list(self.sessions.items())
+        room_ids = [room_id for room_id in list(self.chatrooms)
+                    if self.owner_of(room_id) == self.node_id]
+
+        rooms = {room_id: [] for room_id in room_ids}
+        for token, (room_id, name, last_seen) in sessions:
+            rooms.setdefault(room_id, []).append((token, last_seen, name))
+
+        # the members of the rooms which haven't been restored are kept
+        # without the expired sessions.
+        expired = time.time() - self.session_ttl
+        for room_id, (offset, length) in unrestored:
+            members = rooms.setdefault(room_id, [])
+            tokens = {token for token, last_seen, name in members}
+            members += [member for member in unpack_snapshot_room(self.snapshot_data, offset)
+                        if member[1] >= expired and member[0] not in tokens]
+
+        packed = [(room_id, pack_snapshot_room(members))
+                  for room_id, members in rooms.items()]
+        write_snapshot(self.snapshot_path, packed)
+
+    def snapshot_worker(self):
+        while self.is_running:
+            time.sleep(self.snapshot_interval)
+
+            if self.snapshot_dirty:
+                self.snapshot_dirty = False
+                self.save_snapshot()
+
+    def expire_sessions(self):
+        now = time.time()
+        for token, (room_id, name, last_seen) in list(self.sessions.items()):
+            chatUser = self.session_users.get(token)
+            if chatUser is not None and chatUser.conn.is_running:
+                # the user is still connected.
+                self.sessions[token] = (room_id, name, now)
+            elif last_seen < now - self.session_ttl:
+                # the user whose connection was lost leaves the room now.
+                if chatUser is not None:
+                    self.remove_user(chatUser)
+                else:
+                    self.sessions.pop(token, None)
+
+        self.snapshot_dirty = True
+
+    def session_worker(self):
+        while self.is_running:
+            time.sleep(SESSION_CHECK_INTERVAL)
+            self.expire_sessions()
+
+    def index_worker(self):
+        # index the messages sent in every room, away from the broadcast.
+        while self.is_running:
+            time.sleep(SEARCH_INDEX_INTERVAL)
+
+            for chatRoom in list(self.chatrooms.values()):
+                chatRoom.index_messages()
+
+    def presence_worker(self):
+        # send out the merged joins and leaves of every room periodically.
+        while self.is_running:
+            time.sleep(PRESENCE_INTERVAL)
+
+            for chatRoom in list(self.chatrooms.values()):
+                chatRoom.flush_presence()
+
+            # the accepted links which have stopped.
+            for node, link in list(self.peer_links.items()):
+                if not link.is_running:
+                    self.peer_lost(node, link)
+
     def run(self):
         self.server.set_request_handler(self.client_handler)
-        self.server.run()
+
+        if self.snapshot_path is not None:
+            self.load_snapshot()
 
         self.is_running = True
+        Thread(target=self.presence_worker, daemon=True).start()
+        Thread(target=self.index_worker, daemon=True).start()
+        Thread(target=self.session_worker, daemon=True).start()
+
+        if self.snapshot_path is not None:
+            Thread(target=self.snapshot_worker, daemon=True).start()
+
+        for node in range(self.node_id):
+            Thread(target=self.peer_dialer, args=(node,), daemon=True).start()
+
+        self.server.run()
+        self.is_running = False
+
+        if self.snapshot_path is not None:
+            self.save_snapshot()
 
     def stop(self):
-        for user in self.authorized_user:
+        for user in self.authorized_user.values():
             user.conn.send('quit')
 
         self.is_running = False
         self.server.stop()
 
 class ChatUser:
-    def __init__(self, name, room, conn):
+    def __init__(self, name, room, conn, token=None):
         self.name = name
         self.room = room
         self.conn = conn
+        self.token = token  # the resume token of the session.
 
 class ChatRoom:
-    def __init__(self):
-        self.id = ''.join([str(random.randint(0, 9)) for _ in range(4)])
+    def __init__(self, room_id):
+        self.id = room_id
         self.users = dict()  # (socket name, ChatUser instance)
         self.usernames = set() # just to validate to avoid repeated names.
 
+        # the members connected to the other nodes of the federation.
+        self.remote_users = dict() # (lowercase name, (node id, name))
+
+        # the messages broadcast to the room, waiting to be indexed.
+        self.unindexed_messages = deque()
+        self.message_index = MessageIndex()
+
+        # the roster version increases on every join and leave.
+        self.roster_version = 0
+        # the members who joined or left since the last presence update.
+        self.pending_presence = dict() # (lowercase name, [was member, name])
+        self.presence_lock = RLock()
+
+    def let_in(self, chat_user):
+        with self.presence_lock:
+            # take the roster and queue it before the user is added, so that
+            # the next delta is always newer than the sent roster.
+            names = self.member_names()
+            pages = split_frames(names)
+
+            chat_user.conn.send_multiple(['let_in', chat_user.name, self.id,
+                                          str(self.roster_version),
+                                          str(len(names)), str(len(pages)),
+                                          chat_user.token])
+            for page_no, page in enumerate(pages, 1):
+                chat_user.conn.send_multiple(['roster_page',
+                                              str(self.roster_version),
+                                              str(page_no), *page])
+
+            self.add_user(chat_user)
+
     def add_user(self, chat_user):
-        self.users[chat_user.conn.addr] = chat_user
-        self.usernames.add(chat_user.name.lower())
-        self.broadcast('stat_update', 'NOTICE', f'{chat_user.name} joined the chat.')
+        with self.presence_lock:
+            self.queue_presence(chat_user.name)
+            self.users[chat_user.conn.addr] = chat_user
+            self.usernames.add(chat_user.name.lower())
+            self.roster_version += 1
 
     def remove_user(self, chat_user):
-        self.users.pop(chat_user.conn.addr)
-        self.usernames.remove(chat_user.name.lower())
-        self.broadcast('stat_update', 'NOTICE', f'{chat_user.name} left the chat.')
+        with self.presence_lock:
+            self.queue_presence(chat_user.name)
+            self.users.pop(chat_user.conn.addr)
+            self.usernames.remove(chat_user.name.lower())
+            self.roster_version += 1
+
+    def add_remote_user(self, node, name):
+        with self.presence_lock:
+            self.queue_presence(name)
+            self.remote_users[name.lower()] = (node, name)
+            self.usernames.add(name.lower())
+            self.roster_version += 1
+
+    def remove_remote_user(self, name):
+        with self.presence_lock:
+            if name.lower() not in self.remote_users:
+                return
+
+            self.queue_presence(name)
+            self.remote_users.pop(name.lower())
+            self.usernames.remove(name.lower())
+            self.roster_version += 1
+
+    def member_names(self):
+        return [self.users[x].name for x in self.users] +\
+               [name for node, name in self.remote_users.values()]
+
+    # the other nodes which have at least a member in this room.
+    def member_nodes(self):
+        return {node for node, name in self.remote_users.values()}
+
+    def queue_presence(self, name):
+        # remember whether the name was a member before the first change and
+        # the latest spelling of it, repeated joins and leaves within an
+        # interval are merged.
+        if name.lower() not in self.pending_presence:
+            self.pending_presence[name.lower()] = [name.lower() in self.usernames, name]
+        else:
+            self.pending_presence[name.lower()][1] = name
+
+    def flush_presence(self):
+        with self.presence_lock:
+            if not self.pending_presence:
+                return
+
+            # every changed name is sent with its current state, since the
+            # members who joined in this interval have a newer roster than
+            # the previous delta.
+            changes = []
+            joined = []
+            left = []
+            for name_key, (was_member, name) in self.pending_presence.items():
+                if name_key in self.usernames:
+                    changes.append(f'+{name}')
+                    if not was_member:
+                        joined.append(name)
+                else:
+                    changes.append(f'-{name}')
+                    if was_member:
+                        left.append(name)
+
+            self.pending_presence = dict()
+
+            frames = split_frames(changes)
+            for part_no, frame in enumerate(frames, 1):
+                self.broadcast('roster_delta', str(self.roster_version),
+                               str(part_no), str(len(frames)), *frame)
+
+            summary = []
+            if joined:
+                summary.append(f'{summarize_names(joined)} joined the chat.')
+            if left:
+                summary.append(f'{summarize_names(left)} left the chat.')
+            if summary:
+                self.broadcast('stat_update', 'NOTICE', ' '.join(summary))
 
     def broadcast(self, msg_type, *msg):
         for user in self.users:
             self.users[user].conn.send_multiple([msg_type, *msg])
 
+        # keep the messages for the search. (username, content, date)
+        if msg_type == 'msg_out':
+            self.unindexed_messages.append(msg)
+
+    def index_messages(self):
+        # both the index worker and a search may take the messages.
+        while True:
+            try:
+                msg = self.unindexed_messages.popleft()
+            except IndexError:
+                break
+
+            self.message_index.add(*msg)
+
+        self.message_index.evict()
+
+    def search(self, query, page):
+        # the messages just sent can be found as well.
+        self.index_messages()
+
+        return self.message_index.search(query, page)
+
+# an inverted index of the recent messages of a room, from each word to the
+# messages containing it.
+class MessageIndex:
+    def __init__(self, max_messages=SEARCH_MAX_MESSAGES, max_age=SEARCH_MAX_AGE):
+        self.max_messages = max_messages
+        self.max_age = max_age
+
+        # the indexed messages, numbered from the oldest to the latest.
+        # (message no, (indexed time, username, content, date, words))
+        self.messages = dict()
+        self.first_message_no = 0
+        # the messages containing each word, in the order they were indexed.
+        self.postings = dict() # (word, dict(message no, word count))
+        self.next_message_no = 0
+        self.lock = Lock()
+
+    def add(self, name, content, date):
+        words = dict()
+        for word in split_words(content):
+            words[word] = words.get(word, 0) + 1
+
+        with self.lock:
+            message_no = self.next_message_no
+            self.next_message_no += 1
+
+            for word, count in words.items():
+                self.postings.setdefault(word, dict())[message_no] = count
+
+            self.messages[message_no] = (time.time(), name, content, date,
+                                         tuple(words))
+
+    def evict(self):
+        expired = time.time() - self.max_age
+
+        with self.lock:
+            while self.messages and\
+                    (len(self.messages) > self.max_messages or
+                     self.messages[self.first_message_no][0] < expired):
+                message_no = self.first_message_no
+                self.first_message_no += 1
+                for word in self.messages.pop(message_no)[4]:
+                    posting = self.postings[word]
+                    del posting[message_no]
+                    if not posting:
+                        del self.postings[word]
+
+    def search(self, query, page, page_size=SEARCH_PAGE_SIZE):
+        # returns the (username, date, content) of the messages in the page,
+        # the number of the matches, and whether there may be more matches
+        # than that. every word must be in the message.
+        words = list(dict.fromkeys(split_words(query)))
+
+        with self.lock:
+            postings = [self.postings.get(word) for word in words]
+            if not words or None in postings:
+                return [], 0, False
+
+            # go through the rarest word, and check the others.
+            postings.sort(key=len)
+            weights = [math.log(1 + len(self.messages) / len(posting))
+                       for posting in postings]
+
+            matches = []
+            is_partial = False
+            for scanned, message_no in enumerate(reversed(postings[0])):
+                if scanned >= SEARCH_MAX_SCAN or len(matches) >= SEARCH_MAX_RESULTS:
+                    is_partial = True
+                    break
+
+                if all(message_no in posting for posting in postings[1:]):
+                    score = sum(posting[message_no] * weight
+                                for posting, weight in zip(postings, weights))
+                    matches.append((score, message_no))
+
+            # the higher score, then the latest first.
+            matches.sort(reverse=True)
+
+            results = []
+            for score, message_no in matches[(page - 1) * page_size:page * page_size]:
+                indexed_time, name, content, date, message_words = self.messages[message_no]
+                results.append((name, date, content[:SEARCH_SNIPPET_LENGTH]))
+
+            return results, len(matches), is_partial
+
+# split the names into the groups that each fits in a single frame.
+def split_frames(names, max_bytes=ROSTER_FRAME_BYTES):
+    frames = []
+    frame = []
+    frame_bytes = 0
+    for name in names:
+        name_bytes = len(name.encode('utf-8')) + 2   # including the separator
+        if frame and frame_bytes + name_bytes > max_bytes:
+            frames.append(frame)
+            frame = []
+            frame_bytes = 0
+
+        frame.append(name)
+        frame_bytes += name_bytes
+
+    if frame:
+        frames.append(frame)
+
+    return frames
+
+def split_words(text):
+    return re.findall(r'\w+', text.lower())
+
+def pack_snapshot_room(members):
+    # the member count, then the token, the last seen time and the name of
+    # each member.
+    parts = [struct.pack('<I', len(members))]
+    for token, last_seen, name in members:
+        name = name.encode('utf-8')
+        parts.append(SNAPSHOT_MEMBER.pack(bytes.fromhex(token), last_seen, len(name)))
+        parts.append(name)
+
+    return b''.join(parts)
+
+def unpack_snapshot_room(data, offset):
+    count, = struct.unpack_from('<I', data, offset)
+    offset += 4
+
+    members = []
+    for _ in range(count):
+        token, last_seen, name_length = SNAPSHOT_MEMBER.unpack_from(data, offset)
+        offset += SNAPSHOT_MEMBER.size
+        members.append((token.hex(), last_seen,
+                        data[offset:offset + name_length].decode('utf-8')))
+        offset += name_length
+
+    return members
+
+def write_snapshot(path, rooms):
+    # rooms: the list of (room id, packed members)
+    offset = SNAPSHOT_HEADER.size + SNAPSHOT_INDEX.size * len(rooms)
+    index = []
+    for room_id, packed in rooms:
+        index.append(SNAPSHOT_INDEX.pack(room_id.encode('ascii'), offset, len(packed)))
+        offset += len(packed)
+
+    # write to the other file first, so that a crash while writing can't
+    # break the previous snapshot.
+    with open(path + '.tmp', 'wb') as f:
+        f.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION,
+                                     len(rooms), time.time()))
+        f.write(b''.join(index))
+        f.write(b''.join(packed for room_id, packed in rooms))
+
+    os.replace(path + '.tmp', path)
+
+def read_snapshot_index(data):
+    magic, version, count, saved_time = SNAPSHOT_HEADER.unpack_from(data, 0)
+    if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION:
+        raise ValueError('Not a snapshot of this version.')
+
+    index = dict()
+    for i in range(count):
+        room_id, offset, length = SNAPSHOT_INDEX.unpack_from(data, SNAPSHOT_HEADER.size +
+                                                             SNAPSHOT_INDEX.size * i)
+        index[room_id.decode('ascii')] = (offset, length)
+
+    return index
+
+# e.g. "a", "a and b", "a, b, c and 5 others"
+def summarize_names(names, max_listed=3):
+    if len(names) == 1:
+        return names[0]
+    if len(names) <= max_listed:
+        return f'{", ".join(names[:-1])} and {names[-1]}'
+
+    others = len(names) - max_listed
+    return f'{", ".join(names[:max_listed])} and {others} {"other" if others == 1 else "others"}'
+
 if __name__ == '__main__':
-    host = '127.0.0.1'
-    port = 9999
+    parser = argparse.ArgumentParser(description='Takumi Messenger server')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=9999)
+    # the chat is served over TLS when the certificate is given.
+    parser.add_argument('--cert', help='certificate file for TLS')
+    parser.add_argument('--key', help='private key file for TLS')
+    # e.g. --node-id 1 --nodes 127.0.0.1:9999 127.0.0.1:10000
+    parser.add_argument('--node-id', type=int, default=0,
+                        help='index of this server in --nodes')
+    parser.add_argument('--nodes', nargs='*', default=[],
+                        help='host:port of every node in the federation')
+    parser.add_argument('--federation-key', default='',
+                        help='shared secret of the federation nodes, required '
+                             'with several --nodes (sent in plaintext without --cert)')
+    parser.add_argument('--admin-port', type=int,
+                        help='serve the admin console on this port of localhost')
+    parser.add_argument('--snapshot', help='file to keep the rooms across restarts')
+    parser.add_argument('--snapshot-interval', type=float, default=SNAPSHOT_INTERVAL)
+    parser.add_argument('--session-ttl', type=float, default=SESSION_TTL,
+                        help='seconds to keep the session of a lost connection')
+    parser.add_argument('--backlog', type=int, default=128,
+                        help='the length of the listen queue')
+    parser.add_argument('--max-connections', type=int,
+                        help='the maximum number of connections at once, each '
+                             'takes 3 file descriptors')
+    parser.add_argument('--max-per-ip', type=int,
+                        help='the maximum number of connections from an address')
+    parser.add_argument('--auth-timeout', type=float, default=AUTH_TIMEOUT,
+                        help='seconds a client has to join a room after connecting')
+    args = parser.parse_args()
+
+    ssl_context = None
+    peer_ssl_context = None
+    if args.cert:
+        ssl_context = create_server_ssl_context(args.cert, args.key)
+        peer_ssl_context = create_client_ssl_context(args.cert)
+
+    nodes = None
+    if args.nodes:
+        nodes = [(node.rsplit(':', 1)[0], int(node.rsplit(':', 1)[1]))
+                 for node in args.nodes]
 
-    chat = ChatServer(host, port, is_prompt=True)
+    chat = ChatServer(args.host, args.port, is_prompt=True,
+                      ssl_context=ssl_context, node_id=args.node_id,
+                      nodes=nodes, federation_key=args.federation_key,
+                      peer_ssl_context=peer_ssl_context,
+                      admin_port=args.admin_port, snapshot_path=args.snapshot,
+                      snapshot_interval=args.snapshot_interval,
+                      session_ttl=args.session_ttl,
+                      backlog=args.backlog, max_connections=args.max_connections,
+                      max_per_ip=args.max_per_ip, auth_timeout=args.auth_timeout)
     chat.run()
@@ -6,22 +6,210 @@
 # Import essential module
 from select import select
 from threading import Event
+from threading import Lock
 from threading import Thread
+from threading import enumerate as enumerate_threads
+import errno
 import os
 import platform
+import re
+import selectors
 import socket
+import ssl
 import sys
 import time
 import traceback
 
+# every message is terminated with the ASCII record separator, so that the
+# messages which arrive in the same read can be told apart.
+FRAME_END = b'\x1e'
+# the connection is stopped when a message grows longer than this many bytes
+# without its terminator.
+MAX_FRAME_BYTES = 64 * 1024
+
+# the errors of `accept()` which mean the process is out of resources for now,
+# the server waits a while before accepting again. (up to the maximum seconds)
+ACCEPT_RESOURCE_ERRORS = (errno.EMFILE, errno.ENFILE, errno.ENOBUFS, errno.ENOMEM)
+ACCEPT_MAX_BACKOFF = 1
+
+# the connections wait with `poll`, which has no limit on the descriptor
+# numbers like `select` has. (FD_SETSIZE, usually 1024)
+ConnectionSelector = getattr(selectors, 'PollSelector', selectors.SelectSelector)
+
+
+# a pair of connected sockets, the writer wakes up a thread which is waiting
+# for the reader in `select`. (the `socket` argument of `Connection` hides the
+# module there)
+def create_wake_pair():
+    wake_reader, wake_writer = socket.socketpair()
+    wake_writer.setblocking(False)
+
+    return wake_reader, wake_writer
+
+# build the TLS context for the server side from a certificate chain and its
+# private key. Session tickets are kept enabled, so the clients which have
+# already connected once can resume the session without the full handshake.
+def create_server_ssl_context(certfile, keyfile=None, num_tickets=2):
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.minimum_version = ssl.TLSVersion.TLSv1_2
+    context.load_cert_chain(certfile, keyfile)
+
+    # TLS 1.2 resumption relies on session tickets, TLS 1.3 sends
+    # `num_tickets` tickets to the client after the handshake.
+    context.options &= ~ssl.OP_NO_TICKET
+    context.num_tickets = num_tickets
+
+    return context
+
+# build the TLS context for the client side. `cafile` is the certificate used
+# to verify the server (e.g. a self-signed certificate for local testing).
+def create_client_ssl_context(cafile=None, check_hostname=True):
+    context = ssl.create_default_context(cafile=cafile)
+    context.minimum_version = ssl.TLSVersion.TLSv1_2
+    context.check_hostname = check_hostname
+
+    return context
+
+# the time spent by the request handler, grouped by the command (the first
+# part of the received message), shared by every connection of a server.
+class CommandTimer:
+    # the commands which aren't known are timed together under this name, so
+    # that the clients can't add the names without limit.
+    OTHER = '(other)'
+
+    def __init__(self, max_commands=64):
+        self.stats = dict() # (command, [count, total seconds, max seconds])
+        self.lock = Lock()
+
+        # the commands the request handler knows, registered by `add_commands()`.
+        # until then, only the first max_commands names are timed apart.
+        self.commands = set()
+        self.max_commands = max_commands
+
+    def add_commands(self, commands):
+        with self.lock:
+            self.commands.update(commands)
+
+    def record(self, command, elapsed):
+        with self.lock:
+            if command not in self.stats and\
+                    (self.commands and command not in self.commands or
+                     len(self.stats) >= self.max_commands):
+                command = self.OTHER
+
+            if command not in self.stats:
+                self.stats[command] = [0, 0.0, 0.0]
+
+            stat = self.stats[command]
+            stat[0] += 1
+            stat[1] += elapsed
+            stat[2] = max(stat[2], elapsed)
+
+    def reset(self):
+        with self.lock:
+            self.stats = dict()
+
+    def report(self):
+        with self.lock:
+            stats = sorted(self.stats.items(), key=lambda x: x[1][1], reverse=True)
+
+        lines = ['%-20s %8s %12s %10s %10s' % ('command', 'count', 'total (ms)',
+                                              'avg (ms)', 'max (ms)')]
+        for command, (count, total, longest) in stats:
+            lines.append('%-20s %8d %12.2f %10.3f %10.3f' % (command[:20], count,
+                                                            total * 1000,
+                                                            total * 1000 / count,
+                                                            longest * 1000))
+        return '\n'.join(lines)
+
+# sample the call stacks of every connection thread periodically, then
+# collapse them into the "frame;frame;frame count" lines used by flamegraphs.
+class SamplingProfiler(Thread):
+    def __init__(self, interval=0.005):
+        super().__init__(daemon=True)
+
+        self.interval = interval
+        self.stacks = dict() # (collapsed stack, sample count)
+        self.samples = 0
+        self.is_running = False
+
+    def run(self):
+        self.is_running = True
+
+        while self.is_running:
+            threads = {thread.ident: thread for thread in enumerate_threads()
+                       if isinstance(thread, Connection)}
+
+            for ident, frame in sys._current_frames().items():
+                if ident not in threads:
+                    continue
+
+                stack = []
+                while frame is not None:
+                    stack.append(f'{os.path.basename(frame.f_code.co_filename)}:'
+                                 f'{frame.f_code.co_name}')
+                    frame = frame.f_back
+
+                collapsed = ';'.join(reversed(stack))
+                self.stacks[collapsed] = self.stacks.get(collapsed, 0) + 1
+
+            self.samples += 1
+            time.sleep(self.interval)
+
+    def stop(self):
+        self.is_running = False
+
+    def dump(self, path):
+        with open(path, 'w') as f:
+            for stack, count in list(self.stacks.items()):
+                f.write(f'{stack} {count}\n')
 
 # make a class of the connection, for the easier management.
 class Server:
-    def __init__(self, host, port, is_prompt=False):
+    def __init__(self, host, port, is_prompt=False, ssl_context=None,
+                 handshake_timeout=10, admin_port=None, backlog=128,
+                 accept_batch=64, max_connections=None, max_per_ip=None,
+                 max_pending=256, auth_timeout=None, profile_dir='profiles'):
         # server info
         self.host = host
         self.port = port
 
+        # admission control. the connections over the limits are rejected
+        # right after they're accepted. (None means no limit)
+        # each connection takes 3 file descriptors, its socket and the pair of
+        # sockets which wakes its thread up, so max_connections should stay
+        # below a third of the open file limit.
+        self.backlog = backlog
+        self.accept_batch = accept_batch    # accepted at most per wakeup.
+        self.max_connections = max_connections
+        self.max_per_ip = max_per_ip
+
+        # the connections which haven't finished the TLS handshake or got the
+        # accept message yet, so that a burst of new or idle clients can't
+        # take up every connection slot.
+        self.max_pending = max_pending
+        # if it's given, the connections are pending until the request handler
+        # calls `establish()` on them, e.g. when the user has signed in, and
+        # the ones which aren't established within this many seconds are
+        # stopped.
+        self.auth_timeout = auth_timeout
+
+        self.admission_lock = Lock()
+        self.connection_count = 0   # including the pending ones.
+        self.pending_count = 0
+        self.ip_counts = dict() # (ip address, connection count)
+        self.rejected_count = 0
+
+        # the admin console is served on this port of localhost as well as
+        # the standard input, if it's given.
+        self.admin_port = admin_port
+
+        # the TLS context, the connection will be plaintext if it's None.
+        self.ssl_context = ssl_context
+
+        # the maximum seconds allowed for a client to finish the TLS handshake.
+        self.handshake_timeout = handshake_timeout
+
         # determine whether the server should print the connection status to the
         # standard i/o.
         self.is_prompt = is_prompt
@@ -41,6 +229,34 @@ class Server:
         # set the initial handler status to the empty tuple.
         self.request_handler_args = ()
 
+        # the connections which have started, for the admin console.
+        self.connections = set()
+        self.command_timer = CommandTimer()
+        self.profiler = None
+        # `prof dump` writes only to this directory, since anyone on this
+        # machine can use the admin port.
+        self.profile_dir = profile_dir
+
+        # the commands of the admin console. (name, (handler, help message))
+        # the handler accepts the list of arguments and returns the output.
+        self.admin_commands = dict()
+        self.add_admin_command('help', self.admin_help,
+                               'help - show this message')
+        self.add_admin_command('prof', self.admin_prof,
+                               'prof start [interval ms] | stop | dump [file name]'
+                               ' - sample the stacks of the connections')
+        self.add_admin_command('cmds', self.admin_cmds,
+                               'cmds [reset] - time spent on each command')
+        self.add_admin_command('slow', self.admin_slow,
+                               'slow [n] - the slowest connections')
+        self.add_admin_command('queues', self.admin_queues,
+                               'queues [n] - the longest sending queues')
+        self.add_admin_command('admission', self.admin_admission,
+                               'admission [n] - connection limits and the busiest addresses')
+
+    def add_admin_command(self, name, handler, help_msg=''):
+        self.admin_commands[name] = (handler, help_msg)
+
     def set_request_handler(self, handler, *args):
         if self.is_running:
             raise Exception('The handler must be set before the connection was established.')
@@ -59,9 +275,13 @@ class Server:
 
         # socket
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        # the port can be taken again right after a restart.
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         # listen to the specific port.
         self.socket.bind((self.host, self.port))
-        self.socket.listen()
+        self.socket.listen(self.backlog)
+        # the pending connections are accepted until there's none left.
+        self.socket.setblocking(False)
 
         # Tell the user that the server started listening to the specific port.
         if self.is_prompt:
@@ -70,6 +290,12 @@ class Server:
         # set the running state to True
         self.is_running = True
 
+        if self.admin_port is not None:
+            Thread(target=self.admin_listener, daemon=True).start()
+
+        # the seconds to wait after running out of file descriptors.
+        accept_backoff = 0.01
+
         # keep the server running
         while self.is_running:
 
@@ -77,45 +303,287 @@ class Server:
             # server from working.
             # The default command is set to 'qt' (quit)
             if not self.is_terminal_getch_running:
+                # set before the thread starts, or the next pass of the loop
+                # might start another reader.
+                self.is_terminal_getch_running = True
                 tg_thread = Thread(target=self.wait_to_kill)
                 tg_thread.start()
 
             try:
-                client_socket, client_addr = self.socket.accept()
+                read_ready, write_ready, in_error = select([self.socket], [], [], 1)
+            # the listening socket is closed by `stop()`.
+            except (OSError, ValueError):
+                if not self.is_running:
+                    break
+                raise
+
+            for _ in range(self.accept_batch if len(read_ready) else 0):
+                try:
+                    client_socket, client_addr = self.socket.accept()
+                except BlockingIOError:
+                    break
+                except (OSError, ValueError) as e:
+                    if not self.is_running:
+                        break
+
+                    if isinstance(e, OSError) and e.errno in ACCEPT_RESOURCE_ERRORS:
+                        # the clients stay in the listen queue until some
+                        # connections are closed.
+                        if self.is_prompt:
+                            print(f'The server can\'t accept more clients now: {e}')
+                        time.sleep(accept_backoff)
+                        accept_backoff = min(accept_backoff * 2, ACCEPT_MAX_BACKOFF)
+                        break
+
+                    # the client has gone before it was accepted, e.g.
+                    # ECONNABORTED or EPROTO.
+                    continue
+
+                accept_backoff = 0.01
+                self.admit(client_socket, client_addr)
+
+    def admit(self, client_socket, client_addr):
+        client_socket.setblocking(True)
+
+        with self.admission_lock:
+            reason = None
+            if self.max_connections is not None and\
+                    self.connection_count >= self.max_connections:
+                reason = 'Too many connections'
+            elif self.max_per_ip is not None and\
+                    self.ip_counts.get(client_addr[0], 0) >= self.max_per_ip:
+                reason = 'Too many connections from your address'
+            elif self.pending_count >= self.max_pending:
+                reason = 'Too many pending connections'
+            else:
+                self.connection_count += 1
+                self.pending_count += 1
+                self.ip_counts[client_addr[0]] = self.ip_counts.get(client_addr[0], 0) + 1
 
-                if self.is_prompt:
-                    print(f'Client from {client_addr} request to connect.')
-
-                curr_process = Connection(socket=client_socket,
-                                          addr=client_addr,
-                                          request_handler=self.request_handler,
-                                          request_args=self.request_handler_args,
-                                          send_accept_msg=True,
-                                          is_prompt=self.is_prompt,
-                                          daemon=True)
-                curr_process.start()
-
-            except socket.timeout:
-                if self.is_prompt:
-                    print('There was a request, but reached the connection timeout.')
+        if reason is not None:
+            self.reject(client_socket, client_addr, reason)
+            return
+
+        if self.is_prompt:
+            print(f'Client from {client_addr} request to connect.')
+
+        # only wrap the socket here, the handshake itself is done by the
+        # connection thread, so that a slow client can't block the other
+        # clients from being accepted.
+        if self.ssl_context is not None:
+            client_socket = self.ssl_context.wrap_socket(client_socket,
+                                                         server_side=True,
+                                                         do_handshake_on_connect=False)
+
+        try:
+            curr_process = Connection(socket=client_socket,
+                                      addr=client_addr,
+                                      request_handler=self.request_handler,
+                                      request_args=self.request_handler_args,
+                                      send_accept_msg=True,
+                                      is_prompt=self.is_prompt,
+                                      tls_handshake=self.ssl_context is not None,
+                                      handshake_timeout=self.handshake_timeout,
+                                      auth_timeout=self.auth_timeout,
+                                      command_timer=self.command_timer,
+                                      on_established=self.connection_established,
+                                      on_close=self.connection_closed,
+                                      daemon=True)
+        except OSError as e:
+            # no file descriptors are left for the wake-up sockets.
+            client_socket.close()
+            self.release(client_addr, is_pending=True)
+            if self.is_prompt:
+                print(f'Client from {client_addr} was dropped: {e}')
+            return
+
+        self.connections.add(curr_process)
+        curr_process.start()
+
+    def reject(self, client_socket, client_addr, reason):
+        with self.admission_lock:
+            self.rejected_count += 1
+
+        # tell the client why without waiting for it, then close.
+        try:
+            client_socket.setblocking(False)
+            client_socket.send(f'503: {reason}\r\n'.encode('utf-8') + FRAME_END)
+        except OSError:
+            pass
+        client_socket.close()
+
+        if self.is_prompt:
+            print(f'Client from {client_addr} was rejected: {reason}')
+
+    def release(self, client_addr, is_pending=False):
+        with self.admission_lock:
+            self.connection_count -= 1
+            if is_pending:
+                self.pending_count -= 1
+            self.ip_counts[client_addr[0]] -= 1
+            if self.ip_counts[client_addr[0]] == 0:
+                del self.ip_counts[client_addr[0]]
+
+    def connection_established(self, conn):
+        with self.admission_lock:
+            self.pending_count -= 1
+
+    def connection_closed(self, conn):
+        self.connections.discard(conn)
+        self.release(conn.addr, is_pending=not conn.is_established)
 
     def wait_to_kill(self):
-        if not self.is_terminal_getch_running:
+        # started once by `run()`, which sets the flag before the thread starts.
 
-            # if the operating system is Windows,
-            # make it compatible with terminal color display.
-            if platform.system() == 'Windows':
-                os.system('color')
+        # if the operating system is Windows,
+        # make it compatible with terminal color display.
+        if platform.system() == 'Windows':
+            os.system('color')
 
-            # Notify the terminal user about how to quit the session.
-            print('\033[1m\033[31mTo stop this server session, type "qt" then press Enter.\033[0m\033[0m')
+        # Notify the terminal user about how to quit the session.
+        print('\033[1m\033[31mTo stop this server session, type "qt" then press Enter.\033[0m\033[0m')
+        print('\033[1m\033[31mType "help" for the other admin commands.\033[0m\033[0m')
 
-            self.is_terminal_getch_running = True
-            terminal_getch = ''
-            while terminal_getch != 'qt':
-                terminal_getch = sys.stdin.read(2)
+        terminal_getch = ''
+        while terminal_getch != 'qt':
+            try:
+                terminal_getch = sys.stdin.readline()
+            except (OSError, ValueError):
+                # the standard input can't be read, e.g. under a test runner.
+                terminal_getch = ''
 
-            self.stop()
+            # the standard input is closed, only the admin port is left.
+            if terminal_getch == '':
+                return
+
+            terminal_getch = terminal_getch.strip()
+            if terminal_getch not in ('qt', ''):
+                print(self.admin_command(terminal_getch))
+
+        self.stop()
+
+    def admin_listener(self):
+        # the admin console on the local port, one line per command.
+        admin_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        admin_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        admin_socket.bind(('127.0.0.1', self.admin_port))
+        admin_socket.listen()
+
+        if self.is_prompt:
+            print(f'The admin console is listening to 127.0.0.1, at port {self.admin_port}')
+
+        while self.is_running:
+            admin_conn, admin_addr = admin_socket.accept()
+            Thread(target=self.admin_session, args=(admin_conn,),
+                   daemon=True).start()
+
+        admin_socket.close()
+
+    def admin_session(self, admin_conn):
+        with admin_conn, admin_conn.makefile('rw', encoding='utf-8') as f:
+            for line in f:
+                line = line.strip()
+                if line == 'qt':
+                    self.stop()
+                    return
+                if line == '':
+                    continue
+
+                f.write(self.admin_command(line) + '\n')
+                f.flush()
+
+    def admin_command(self, line):
+        args = line.split()
+        if args[0] not in self.admin_commands:
+            return f'Unknown command {args[0]}, type "help" for the list.'
+
+        try:
+            return self.admin_commands[args[0]][0](args[1:])
+        except Exception as e:
+            return f'The command failed: {e}'
+
+    def admin_help(self, args):
+        return '\n'.join(['qt - stop the server'] +
+                         [help_msg for handler, help_msg in self.admin_commands.values()])
+
+    def admin_prof(self, args):
+        if args and args[0] == 'start':
+            if self.profiler is not None and self.profiler.is_running:
+                return 'The profiler is already running.'
+
+            interval = float(args[1]) / 1000 if len(args) > 1 else 0.005
+            self.profiler = SamplingProfiler(interval)
+            self.profiler.start()
+            return f'The profiler started, sampling every {interval * 1000:g} ms.'
+
+        if self.profiler is None:
+            return 'The profiler has never been started.'
+
+        if args and args[0] == 'stop':
+            self.profiler.stop()
+            return f'The profiler stopped after {self.profiler.samples} samples.'
+
+        if args and args[0] == 'dump':
+            file_name = args[1] if len(args) > 1 else f'takumi-{int(time.time())}.folded'
+            if not re.fullmatch(r'\w[\w.-]*', file_name):
+                return 'The file name can only have letters, digits, "_", "-" and ".".'
+
+            os.makedirs(self.profile_dir, exist_ok=True)
+            path = os.path.join(self.profile_dir, file_name)
+            self.profiler.dump(path)
+            return f'The collapsed stacks were written to {path}.'
+
+        return self.admin_commands['prof'][1]
+
+    def admin_cmds(self, args):
+        if args and args[0] == 'reset':
+            self.command_timer.reset()
+            return 'The command timing was reset.'
+
+        return self.command_timer.report()
+
+    def live_connections(self):
+        return [conn for conn in list(self.connections) if conn.is_alive()]
+
+    def admin_slow(self, args):
+        count = int(args[0]) if args else 10
+        conns = sorted(self.live_connections(), key=lambda conn: conn.max_handle_time,
+                       reverse=True)[:count]
+
+        lines = ['%-24s %8s %10s %10s  %s' % ('address', 'handled', 'avg (ms)',
+                                             'max (ms)', 'slowest command')]
+        for conn in conns:
+            lines.append('%-24s %8d %10.3f %10.3f  %s' % (
+                '%s:%d' % conn.addr[:2], conn.handle_count,
+                conn.handle_time * 1000 / max(conn.handle_count, 1),
+                conn.max_handle_time * 1000, conn.slowest_command))
+        lines.append(f'{len(self.live_connections())} connections in total.')
+        return '\n'.join(lines)
+
+    def admin_admission(self, args):
+        count = int(args[0]) if args else 10
+        with self.admission_lock:
+            ip_counts = sorted(self.ip_counts.items(), key=lambda x: x[1],
+                               reverse=True)[:count]
+            lines = [f'connections: {self.connection_count} / {self.max_connections or "unlimited"}',
+                     f'pending: {self.pending_count} / {self.max_pending}',
+                     f'rejected: {self.rejected_count}',
+                     f'per address limit: {self.max_per_ip or "unlimited"}']
+
+        lines.append('%-24s %8s' % ('address', 'count'))
+        for ip, ip_count in ip_counts:
+            lines.append('%-24s %8d' % (ip, ip_count))
+        return '\n'.join(lines)
+
+    def admin_queues(self, args):
+        count = int(args[0]) if args else 10
+        conns = sorted(self.live_connections(), key=lambda conn: len(conn.awaited_data),
+                       reverse=True)[:count]
+
+        lines = ['%-24s %8s' % ('address', 'queued')]
+        for conn in conns:
+            lines.append('%-24s %8d' % ('%s:%d' % conn.addr[:2], len(conn.awaited_data)))
+        return '\n'.join(lines)
 
     def stop(self):
 
@@ -149,7 +617,10 @@ class Connection(Thread):
     def __init__(self, socket, addr, request_handler,
                  accept_msg='200: Success', send_accept_msg=False, group=None, target=None, name=None,
                  request_args=(), args=(), kwargs={},
-                 is_prompt=False, event=None, *, daemon=None):
+                 is_prompt=False, event=None, tls_handshake=False,
+                 handshake_timeout=10, auth_timeout=None, command_timer=None,
+                 on_established=None, on_close=None, *,
+                 daemon=None):
         super().__init__(group=group, target=target, name=name, args=args,
                         kwargs=kwargs, daemon=daemon)
 
@@ -163,19 +634,72 @@ class Connection(Thread):
         # the list for awaited data to be sent to the client.
         self.awaited_data = []
 
+        # the received bytes of the message which hasn't completely arrived.
+        self.recv_buffer = b''
+
+        # written by `send()` to wake the connection thread up.
+        self.wake_reader, self.wake_writer = create_wake_pair()
+        self.selector = ConnectionSelector()
+
         self.send_accept_msg = send_accept_msg
         self.event = event
 
+        # called with this connection when it's established, then when it has
+        # finished running. it's established when the handshake is done and
+        # the accept message is sent, or when `establish()` is called if the
+        # auth timeout is given.
+        self.on_established = on_established
+        self.on_close = on_close
+        self.is_established = False
+        self.establish_lock = Lock()
+        self.auth_timeout = auth_timeout
+        self.auth_deadline = None
+        self.is_closed = False
+
+        # the time spent by the request handler on this connection.
+        self.command_timer = command_timer
+        self.handle_count = 0
+        self.handle_time = 0.0
+        self.max_handle_time = 0.0
+        self.slowest_command = ''
+
+        # whether the TLS handshake has to be done before the session starts.
+        # (the socket must be wrapped with `do_handshake_on_connect=False`)
+        self.tls_handshake = tls_handshake
+        self.handshake_timeout = handshake_timeout
+
         # the function which will be handle the current connection.
         self.request_handler = request_handler
         self.request_args = request_args    # note that args has to accept at least 1
                                             # argument for received data.
 
     def send(self, data):
+        # the messages to a closed connection would never be sent.
+        if self.is_closed:
+            return
+
         self.awaited_data.append(data)
+        self.wake()
 
     def send_multiple(self, data):
+        if self.is_closed:
+            return
+
         self.awaited_data.append('\r\n'.join(data))
+        self.wake()
+
+    def wake(self):
+        # interrupt the `select` of the connection thread, so that it waits
+        # for the socket to be writable as well.
+        try:
+            self.wake_writer.send(b'\0')
+        except OSError:
+            # the wake-up is already pending, or the connection has stopped.
+            pass
+
+    def send_frame(self, msg):
+        # write the whole message to the socket at once, with its terminator.
+        self.socket.sendall(msg.encode('utf-8') + FRAME_END)
 
     def quarantine(self):
         read_ready, write_ready, in_error = select([self.socket],
@@ -187,50 +711,180 @@ class Connection(Thread):
         if len(read_ready) == 0 and len(write_ready) == 0:
             self.stop()
 
+    def establish(self):
+        # might be called by the other threads as well.
+        with self.establish_lock:
+            if self.is_established or self.is_closed:
+                return
+            self.is_established = True
+
+        if self.on_established is not None:
+            self.on_established(self)
+
+    def handshake(self):
+        # limit the time of the handshake, then switch back to the blocking
+        # mode used by the rest of the session.
+        self.socket.settimeout(self.handshake_timeout)
+        self.socket.do_handshake()
+        self.socket.settimeout(None)
+
+        if self.is_prompt:
+            print(f'TLS handshake with {self.addr} finished '
+                  f'({self.socket.version()}, resumed: {self.socket.session_reused}).')
+
+    def handle(self, recv):
+        started = time.perf_counter()
+        self.request_handler(recv, self, *self.request_args)
+        elapsed = time.perf_counter() - started
+
+        self.handle_count += 1
+        self.handle_time += elapsed
+        if elapsed > self.max_handle_time:
+            self.max_handle_time = elapsed
+            self.slowest_command = recv[0]
+
+        if self.command_timer is not None:
+            self.command_timer.record(recv[0], elapsed)
+
     def run(self):
+        try:
+            self.serve()
+        finally:
+            # the socket is closed here as well, since the connection might
+            # have stopped on an error, but its owner can keep it for a while.
+            self.is_running = False
+            with self.establish_lock:
+                self.is_closed = True
+            self.awaited_data = []
+            self.socket.close()
+            self.selector.close()
+            self.wake_reader.close()
+            self.wake_writer.close()
+
+            if self.on_close is not None:
+                self.on_close(self)
+
+    def serve(self):
 
         if not callable(self.request_handler):
             raise Exception('No request handler for each session was defined.')
 
+        if self.tls_handshake:
+            try:
+                self.handshake()
+            except (ssl.SSLError, OSError) as e:
+                # the client couldn't finish the handshake, just drop it.
+                self.socket.close()
+                if (self.event):
+                    self.event.set()
+                if self.is_prompt:
+                    print(f'The TLS handshake with {self.addr} failed: {e}')
+                return
+
         if self.send_accept_msg:
-            self.socket.send(f'{self.accept_msg}\r\n'.encode('utf-8'))
+            self.send_frame(f'{self.accept_msg}\r\n')
+
+        if self.auth_timeout is None:
+            self.establish()
+        else:
+            self.auth_deadline = time.monotonic() + self.auth_timeout
+
         # keep updating the status from client.
         self.is_running = True
 
+        self.selector.register(self.socket, selectors.EVENT_READ)
+        self.selector.register(self.wake_reader, selectors.EVENT_READ)
+        socket_events = selectors.EVENT_READ
+
         while self.is_running:
             try:
-                read_ready, write_ready, in_error = select([self.socket],
-                                                           [self.socket],
-                                                           [], 30)
+                # wait for the socket to be writable only when there's some
+                # data to send, or the loop would never sleep.
+                events = selectors.EVENT_READ
+                if len(self.awaited_data):
+                    events |= selectors.EVENT_WRITE
+                if events != socket_events:
+                    self.selector.modify(self.socket, events)
+                    socket_events = events
+
+                timeout = 30
+                if not self.is_established and self.auth_deadline is not None:
+                    timeout = self.auth_deadline - time.monotonic()
+                    if timeout <= 0:
+                        if self.is_prompt:
+                            print(f'{self.addr} didn\'t sign in in time.')
+                        self.stop()
+                        break
+
+                read_ready = []
+                write_ready = []
+                for key, ready in self.selector.select(min(timeout, 30)):
+                    if ready & selectors.EVENT_READ:
+                        read_ready.append(key.fileobj)
+                    if ready & selectors.EVENT_WRITE:
+                        write_ready.append(key.fileobj)
+
+                if self.wake_reader in read_ready:
+                    self.wake_reader.recv(4096)
+                    read_ready.remove(self.wake_reader)
+
                 #if len(in_error):
                     # do when the socket has some errors.
                     #self.quarantine()
 
+                # the TLS socket might have already buffered the decrypted
+                # data, which `select` can't see.
+                if not len(read_ready) and isinstance(self.socket, ssl.SSLSocket)\
+                        and self.socket.pending():
+                    read_ready = [self.socket]
+
                 if len(read_ready):
                     # do when the socket is ready to receive data..
-                    read_data = self.socket.recv(2048).decode('utf-8')
-
-                    if self.is_prompt:
-                        print(f'Received from {self.addr}: "{read_data}"')
+                    recv_data = self.socket.recv(2048)
 
-                    if read_data == '200: Close the connection\r\n' or\
-                       read_data == '':
+                    if recv_data == b'':
                         self.stop()
+
+                    # only the new bytes can finish a message.
+                    frames = []
+                    if FRAME_END in recv_data:
+                        frames = (self.recv_buffer + recv_data).split(FRAME_END)
+                        self.recv_buffer = frames.pop()
                     else:
-                        self.request_handler(read_data.split('\r\n'), self, *self.request_args)
+                        self.recv_buffer += recv_data
+
+                    if len(self.recv_buffer) > MAX_FRAME_BYTES:
+                        if self.is_prompt:
+                            print(f'The message from {self.addr} is too long.')
+                        self.stop()
+
+                    # handle every message that has completely arrived.
+                    for frame in frames:
+                        if not self.is_running:
+                            break
+
+                        read_data = frame.decode('utf-8')
 
-                if len(write_ready) != 0 and len(self.awaited_data) != 0:
+                        if self.is_prompt:
+                            print(f'Received from {self.addr}: "{read_data}"')
+
+                        if read_data == '200: Close the connection\r\n':
+                            self.stop()
+                        else:
+                            self.handle(read_data.split('\r\n'))
+
+                if self.is_running and len(write_ready) != 0 and\
+                        len(self.awaited_data) != 0:
                     # do when the socket is ready to send data,
                     # only when the socket isn't available for reading,
                     # this is due to the thread-safe connection.
                     msg = self.awaited_data[0]
-                    sent = self.socket.send(msg.encode('utf-8'))
+                    self.send_frame(msg)
 
                     if self.is_prompt:
                         print(f'Sent to {self.addr}: "{msg}"')
 
-                    if sent > 0:
-                        del self.awaited_data[0]
+                    del self.awaited_data[0]
 
                 # wait until the next responding to clients.
                 #time.sleep(0.2)
@@ -252,7 +906,7 @@ class Connection(Thread):
         if not(self.is_running):
             raise Exception('The current client connection has already stopped.')
 
-        self.socket.send('200: Close the connection\r\n'.encode('utf-8'))
+        self.send_frame('200: Close the connection\r\n')
         self.socket.close()
         self.is_running = False
         if self.event:
@@ -267,11 +921,24 @@ class Connection(Thread):
 
 # client-side connection
 class Client:
-    def __init__(self, host, port, is_prompt=False):
+    def __init__(self, host, port, is_prompt=False, ssl_context=None,
+                 server_hostname=None, connect_timeout=10):
         # destination info
         self.host = host
         self.port = port
 
+        # the maximum seconds allowed to connect, finish the TLS handshake and
+        # get the accept message from the server.
+        self.connect_timeout = connect_timeout
+
+        # the TLS context, the connection will be plaintext if it's None.
+        self.ssl_context = ssl_context
+        self.server_hostname = server_hostname or host
+
+        # the TLS session of the latest connection, it's reused when
+        # reconnecting to skip the full handshake.
+        self.tls_session = None
+
         # set the default response handler
         self.response_handler = None
         self.response_args = ()
@@ -297,12 +964,29 @@ class Client:
         try:
             # generate the socket
             self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.socket.settimeout(self.connect_timeout)
             self.socket.connect((self.host, self.port))
 
+            if self.ssl_context is not None:
+                self.socket = self.ssl_context.wrap_socket(self.socket,
+                                                           server_hostname=self.server_hostname,
+                                                           session=self.tls_session)
+
             # Check if server accept the connection
-            if self.socket.recv(2048).decode('utf-8') == f'{accept_msg}\r\n':
+            accepted = self.socket.recv(2048) == f'{accept_msg}\r\n'.encode('utf-8') + FRAME_END
+            # switch back to the blocking mode used by the rest of the session.
+            self.socket.settimeout(None)
+
+            if accepted:
+                if self.ssl_context is not None:
+                    # with TLS 1.3 the session ticket arrives after the
+                    # handshake, so keep the session only after the first read.
+                    self.tls_session = self.socket.session
+
                 if self.is_prompt:
                     print(f'The connection to server {self.host}:{self.port} has started.')
+                    if self.ssl_context is not None:
+                        print(f'TLS session resumed: {self.socket.session_reused}')
 
                 conn_event = Event()
                 self.conn = Connection(socket=self.socket,
@@ -319,9 +1003,16 @@ class Client:
 
                 conn_event.wait()
 
+                # the session has ended, so the client can be run again.
+                self.is_running = False
+
             else:
                 raise Exception('There was a problem connected to the server.')
         except:
+            # the socket isn't owned by a connection yet, if the session
+            # hasn't started.
+            if not hasattr(self, 'conn') or self.conn.socket is not self.socket:
+                self.socket.close()
             raise Exception('The server can\'t be reached for some reasons.')
 
     '''
@@ -343,6 +1034,7 @@ class Client:
             raise Exception('No connection is currently running.')
 
         self.conn.stop()
+        self.is_running = False
 
         if self.is_prompt:
             print(f'The connection to server {self.host}:{self.port} has stopped.')
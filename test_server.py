@@ -0,0 +1,309 @@
+#!/usr/bin/python3
+# test_server.py
+
+from takumi_connection import Client
+from testing_utils import free_port
+from testing_utils import wait_until
+from threading import Thread
+import os
+import server
+import tempfile
+import time
+import unittest
+
+
+# collects the messages sent to a user, without any socket.
+class FakeConn:
+    def __init__(self, addr):
+        self.addr = addr
+        self.is_running = True
+        self.sent = []
+
+    def send(self, data):
+        self.sent.append(data.split('\r\n'))
+
+    def send_multiple(self, data):
+        self.sent.append(list(data))
+
+    def establish(self):
+        self.is_established = True
+
+    def stop(self):
+        self.is_running = False
+
+
+class SplitFramesTest(unittest.TestCase):
+    def test_keeps_every_name_in_order(self):
+        names = [f'user{i}' for i in range(1000)]
+        frames = server.split_frames(names, max_bytes=100)
+
+        self.assertGreater(len(frames), 1)
+        self.assertEqual([name for frame in frames for name in frame], names)
+
+    def test_frames_fit_in_the_limit(self):
+        names = ['é' * 20] * 50 + ['a' * 30] * 50
+        for frame in server.split_frames(names, max_bytes=200):
+            self.assertLessEqual(sum(len(name.encode('utf-8')) + 2 for name in frame), 200)
+
+    def test_no_names(self):
+        self.assertEqual(server.split_frames([]), [])
+
+
+class PresenceTest(unittest.TestCase):
+    def test_large_delta_is_split_into_parts(self):
+        chatRoom = server.ChatRoom('0001')
+        watcher = FakeConn(('127.0.0.1', 1))
+        chatRoom.let_in(server.ChatUser('watcher', chatRoom, watcher, 'token'))
+        chatRoom.flush_presence()
+        watcher.sent = []
+
+        names = [f'user{i:04d}_{"x" * 20}' for i in range(400)]
+        for i, name in enumerate(names):
+            chatRoom.add_remote_user(1, name)
+        chatRoom.flush_presence()
+
+        deltas = [msg for msg in watcher.sent if msg[0] == 'roster_delta']
+        self.assertGreater(len(deltas), 1)
+        for part_no, delta in enumerate(deltas, 1):
+            self.assertEqual(delta[1:4], [str(chatRoom.roster_version), str(part_no),
+                                          str(len(deltas))])
+        self.assertEqual([change for delta in deltas for change in delta[4:]],
+                         [f'+{name}' for name in names])
+
+    def test_repeated_changes_are_merged(self):
+        chatRoom = server.ChatRoom('0001')
+        watcher = FakeConn(('127.0.0.1', 1))
+        chatRoom.let_in(server.ChatUser('watcher', chatRoom, watcher, 'token'))
+        chatRoom.flush_presence()
+        watcher.sent = []
+
+        chatRoom.add_remote_user(1, 'alice')
+        chatRoom.remove_remote_user('alice')
+        chatRoom.add_remote_user(1, 'bob')
+        chatRoom.flush_presence()
+
+        self.assertEqual(watcher.sent, [
+            ['roster_delta', '4', '1', '1', '-alice', '+bob'],
+            ['stat_update', 'NOTICE', 'bob joined the chat.']])
+
+
+class SnapshotTest(unittest.TestCase):
+    def test_room_round_trip(self):
+        members = [('00' * 16, 1.5, 'alice'), ('ff' * 16, 2.25, 'นิว')]
+        packed = server.pack_snapshot_room(members)
+
+        self.assertEqual(server.unpack_snapshot_room(b'xyz' + packed, 3), members)
+
+    def test_file_round_trip(self):
+        rooms = [('0001', server.pack_snapshot_room([('ab' * 16, 1.0, 'bob')])),
+                 ('0042', server.pack_snapshot_room([]))]
+
+        with tempfile.TemporaryDirectory() as path:
+            path = os.path.join(path, 'rooms.snapshot')
+            server.write_snapshot(path, rooms)
+            with open(path, 'rb') as f:
+                data = f.read()
+
+        index = server.read_snapshot_index(data)
+        self.assertEqual(sorted(index), ['0001', '0042'])
+        self.assertEqual(server.unpack_snapshot_room(data, index['0001'][0]),
+                         [('ab' * 16, 1.0, 'bob')])
+        self.assertEqual(server.unpack_snapshot_room(data, index['0042'][0]), [])
+
+    def test_other_version_is_refused(self):
+        data = server.SNAPSHOT_HEADER.pack(server.SNAPSHOT_MAGIC,
+                                           server.SNAPSHOT_VERSION + 1, 0, 0)
+        with self.assertRaises(ValueError):
+            server.read_snapshot_index(data)
+
+
+class SessionTest(unittest.TestCase):
+    def test_lost_sessions_expire(self):
+        chat = server.ChatServer('127.0.0.1', 0, session_ttl=60)
+        alice = FakeConn(('127.0.0.1', 1))
+        bob = FakeConn(('127.0.0.1', 2))
+
+        chat.join_room('alice', 'none', alice)
+        room_id = next(iter(chat.chatrooms))
+        chat.join_room('bob', room_id, bob)
+
+        # both were last seen long ago, but only alice is still connected.
+        bob.is_running = False
+        for token, (session_room, name, last_seen) in list(chat.sessions.items()):
+            chat.sessions[token] = (session_room, name, last_seen - 120)
+        chat.expire_sessions()
+
+        self.assertEqual([name for session_room, name, last_seen in chat.sessions.values()],
+                         ['alice'])
+        self.assertEqual(chat.chatrooms[room_id].member_names(), ['alice'])
+
+    def test_remote_rooms_keep_their_sessions(self):
+        with tempfile.TemporaryDirectory() as path:
+            path = os.path.join(path, 'rooms.snapshot')
+            now = time.time()
+            server.write_snapshot(path, [
+                ('0001', server.pack_snapshot_room([('aa' * 16, now, 'bob')])),
+                ('0003', server.pack_snapshot_room([('bb' * 16, now, 'dave')]))])
+
+            # room 0001 and 0003 are owned by node 1.
+            chat = server.ChatServer('127.0.0.1', 0, node_id=0,
+                                     nodes=[('127.0.0.1', 0), ('127.0.0.1', 1)],
+                                     federation_key='key', snapshot_path=path)
+            chat.load_snapshot()
+
+            # the owner can't be reached, but the sessions of the room are
+            # taken from the snapshot anyway.
+            chat.join_room('carol', '0001', FakeConn(('127.0.0.1', 1)))
+            self.assertNotIn('0001', chat.snapshot_index)
+            self.assertEqual(chat.sessions['aa' * 16][:2], ('0001', 'bob'))
+
+            # a new session of a room which is still in the snapshot.
+            chat.sessions['cc' * 16] = ('0003', 'erin', now)
+            chat.save_snapshot()
+
+            with open(path, 'rb') as f:
+                data = f.read()
+
+        index = server.read_snapshot_index(data)
+        self.assertEqual([name for token, last_seen, name in
+                          server.unpack_snapshot_room(data, index['0001'][0])], ['bob'])
+        self.assertEqual(sorted(name for token, last_seen, name in
+                                server.unpack_snapshot_room(data, index['0003'][0])),
+                         ['dave', 'erin'])
+
+    def test_snapshot_keeps_room_ids(self):
+        chat = server.ChatServer('127.0.0.1', 0)
+        chat.snapshot_index = {str(room_id).zfill(4): (0, 0) for room_id in range(9999)}
+
+        self.assertEqual(chat.allocate_room_id(), '9999')
+
+    def test_room_ids_run_out(self):
+        chat = server.ChatServer('127.0.0.1', 0, node_id=1,
+                                 nodes=[('127.0.0.1', 0), ('127.0.0.1', 1)],
+                                 federation_key='key')
+        chat.snapshot_index = {str(room_id).zfill(4): (0, 0) for room_id in range(1, 10000, 2)}
+
+        self.assertIsNone(chat.allocate_room_id())
+        self.assertEqual(chat.join_room('alice', 'none', FakeConn(('127.0.0.1', 1))),
+                         'No room ID is available, please join an existing room.')
+
+
+class MessageIndexTest(unittest.TestCase):
+    def test_every_word_must_match(self):
+        index = server.MessageIndex()
+        index.add('alice', 'hello world', 'd1')
+        index.add('bob', 'hello there', 'd2')
+
+        self.assertEqual(index.search('HELLO world', 1), ([('alice', 'd1', 'hello world')], 1, False))
+        self.assertEqual(index.search('hello nobody', 1), ([], 0, False))
+        self.assertEqual(index.search('', 1), ([], 0, False))
+
+    def test_ranking(self):
+        index = server.MessageIndex()
+        index.add('alice', 'cat', 'd1')
+        index.add('bob', 'cat cat cat', 'd2')
+        index.add('carol', 'cat', 'd3')
+
+        results, match_count, is_partial = index.search('cat', 1)
+        # the most occurrences first, then the latest.
+        self.assertEqual([name for name, date, content in results], ['bob', 'carol', 'alice'])
+
+    def test_pages(self):
+        index = server.MessageIndex()
+        for i in range(25):
+            index.add('alice', f'word {i}', str(i))
+
+        results, match_count, is_partial = index.search('word', 3, page_size=10)
+        self.assertEqual(match_count, 25)
+        self.assertEqual([date for name, date, content in results], ['4', '3', '2', '1', '0'])
+
+    def test_eviction(self):
+        index = server.MessageIndex(max_messages=10)
+        for i in range(30):
+            index.add('alice', f'word{i} common', str(i))
+        index.evict()
+
+        self.assertEqual(len(index.messages), 10)
+        self.assertEqual(index.search('word5', 1), ([], 0, False))
+        self.assertEqual(index.search('word29', 1)[1], 1)
+        self.assertEqual(index.search('common', 1)[1], 10)
+        self.assertNotIn('word0', index.postings)
+
+    def test_capped_results(self):
+        index = server.MessageIndex()
+        for i in range(server.SEARCH_MAX_RESULTS + 5):
+            index.add('alice', 'spam', str(i))
+
+        results, match_count, is_partial = index.search('spam', 1)
+        self.assertEqual(match_count, server.SEARCH_MAX_RESULTS)
+        self.assertTrue(is_partial)
+
+
+class FederationTest(unittest.TestCase):
+    def setUp(self):
+        ports = [free_port() for _ in range(3)]
+        nodes = [('127.0.0.1', port) for port in ports]
+        self.chats = [server.ChatServer('127.0.0.1', port, node_id=node_id,
+                                        nodes=nodes, federation_key='key')
+                      for node_id, port in enumerate(ports)]
+        for chat in self.chats:
+            Thread(target=chat.run, daemon=True).start()
+
+        self.assertTrue(wait_until(lambda: all(len(chat.peer_links) == 2
+                                               for chat in self.chats)))
+
+        self.received = dict()   # (username, the received messages)
+        self.conns = dict()      # (username, Connection instance)
+
+    def tearDown(self):
+        for chat in self.chats:
+            chat.stop()
+
+    def connect(self, name, node_id, room_id):
+        self.received[name] = []
+
+        def handler(recv, conn):
+            self.received[name].append(recv)
+            self.conns[name] = conn
+            if recv[0] == 'auth':
+                conn.send_multiple(['auth_res', name, room_id])
+
+        client = Client('127.0.0.1', self.chats[node_id].server.port)
+        client.set_response_handler(handler)
+        Thread(target=client.run, daemon=True).start()
+
+    def messages(self, name, msg_type):
+        return [recv for recv in self.received[name] if recv[0] == msg_type]
+
+    def test_rooms_are_shared(self):
+        self.connect('alice', 0, 'none')
+        self.assertTrue(wait_until(lambda: self.messages('alice', 'let_in')))
+        room_id = self.messages('alice', 'let_in')[0][2]
+
+        self.connect('bob', 1, room_id)
+        self.connect('carol', 2, room_id)
+        self.assertTrue(wait_until(lambda: self.messages('bob', 'let_in') and
+                                           self.messages('carol', 'let_in')))
+
+        # the name is taken on the other node.
+        self.connect('Bob', 2, room_id)
+        self.assertTrue(wait_until(lambda: self.messages('Bob', 'stat_update')))
+        self.assertIn('already exists', self.messages('Bob', 'stat_update')[0][2])
+
+        self.conns['carol'].send_multiple(['msg_in', 'hi from carol'])
+        for name in ('alice', 'bob', 'carol'):
+            self.assertTrue(wait_until(lambda: self.messages(name, 'msg_out')))
+            self.assertEqual(self.messages(name, 'msg_out')[0][1:3], ['carol', 'hi from carol'])
+
+        for chat in self.chats:
+            self.assertTrue(wait_until(lambda: chat.chatrooms[room_id].usernames ==
+                                               {'alice', 'bob', 'carol'}))
+
+        # the copy of the room is dropped with its last local member.
+        self.conns['bob'].send_multiple(['msg_in', '\\quit'])
+        self.assertTrue(wait_until(lambda: room_id not in self.chats[1].chatrooms))
+        self.assertTrue(wait_until(lambda: self.chats[0].chatrooms[room_id].usernames ==
+                                           {'alice', 'carol'}))
+
+if __name__ == '__main__':
+    unittest.main()
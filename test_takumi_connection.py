@@ -0,0 +1,448 @@
+#!/usr/bin/python3
+# test_takumi_connection.py
+
+from takumi_connection import Client
+from takumi_connection import CommandTimer
+from takumi_connection import FRAME_END
+from takumi_connection import MAX_FRAME_BYTES
+from takumi_connection import Server
+from takumi_connection import create_client_ssl_context
+from takumi_connection import create_server_ssl_context
+from testing_utils import free_port
+from testing_utils import start_server
+from testing_utils import wait_until
+import os
+import shutil
+import socket
+import struct
+import subprocess
+import tempfile
+import time
+import unittest
+
+
+# greets the client, answers a ping, and closes the connection on bye.
+def greeting_handler(recv, conn):
+    if recv[0] == conn.accept_msg:
+        conn.send('hello')
+    elif recv[0] == 'ping':
+        conn.send('pong')
+    elif recv[0] == 'bye':
+        conn.stop()
+
+
+class FramingTest(unittest.TestCase):
+    def setUp(self):
+        self.server = None
+
+    def tearDown(self):
+        if self.server is not None and self.server.is_running:
+            self.server.stop()
+
+    def test_frames(self):
+        self.server = Server('127.0.0.1', free_port())
+        self.server.set_request_handler(greeting_handler)
+        start_server(self.server)
+
+        with socket.create_connection(('127.0.0.1', self.server.port)) as s:
+            s.settimeout(5)
+            self.assertEqual(s.recv(2048), b'200: Success\r\n' + FRAME_END)
+
+            # two messages in a single write are still told apart.
+            s.sendall(b'200: Success\r\n' + FRAME_END + b'ping' + FRAME_END)
+            data = b''
+            while data.count(FRAME_END) < 2:
+                data += s.recv(2048)
+            self.assertEqual(data, b'hello' + FRAME_END + b'pong' + FRAME_END)
+
+    def test_endless_frame_stops_the_connection(self):
+        self.server = Server('127.0.0.1', free_port())
+        self.server.set_request_handler(greeting_handler)
+        start_server(self.server)
+
+        with socket.create_connection(('127.0.0.1', self.server.port)) as s:
+            s.settimeout(5)
+            s.recv(2048)
+
+            try:
+                s.sendall(b'x' * (MAX_FRAME_BYTES + 4096))
+            except OSError:
+                pass
+
+            data = b''
+            try:
+                while True:
+                    chunk = s.recv(2048)
+                    if chunk == b'':
+                        break
+                    data += chunk
+            except ConnectionResetError:
+                pass
+            self.assertEqual(data, b'200: Close the connection\r\n' + FRAME_END)
+
+        self.assertTrue(wait_until(lambda: self.server.connection_count == 0))
+
+
+class AdmissionTest(unittest.TestCase):
+    def setUp(self):
+        self.server = None
+
+    def tearDown(self):
+        if self.server is not None and self.server.is_running:
+            self.server.stop()
+
+    def test_connections_over_the_limit_are_rejected(self):
+        self.server = Server('127.0.0.1', free_port(), max_per_ip=2)
+        self.server.set_request_handler(greeting_handler)
+        start_server(self.server)
+
+        socks = [socket.create_connection(('127.0.0.1', self.server.port))
+                 for _ in range(3)]
+        try:
+            replies = []
+            for s in socks:
+                s.settimeout(5)
+                replies.append(s.recv(2048))
+
+            self.assertEqual(replies.count(b'200: Success\r\n' + FRAME_END), 2)
+            self.assertIn(b'503: Too many connections from your address\r\n' + FRAME_END,
+                          replies)
+        finally:
+            for s in socks:
+                s.close()
+
+        # the slots are given back when the connections are closed.
+        self.assertTrue(wait_until(lambda: self.server.connection_count == 0))
+        self.assertEqual(self.server.pending_count, 0)
+
+
+    def test_reset_connection_is_closed(self):
+        conns = []
+
+        def handler(recv, conn):
+            conns.append(conn)
+
+        self.server = Server('127.0.0.1', free_port())
+        self.server.set_request_handler(handler)
+        start_server(self.server)
+
+        s = socket.create_connection(('127.0.0.1', self.server.port))
+        s.settimeout(5)
+        s.recv(2048)
+        s.sendall(b'200: Success\r\n' + FRAME_END)
+        self.assertTrue(wait_until(lambda: conns))
+
+        # reset the connection instead of closing it.
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack('ii', 1, 0))
+        s.close()
+
+        self.assertTrue(wait_until(lambda: self.server.connection_count == 0))
+        self.assertEqual(conns[0].socket.fileno(), -1)
+
+
+    def test_connections_are_pending_until_established(self):
+        def handler(recv, conn):
+            if recv[0] == 'sign_in':
+                conn.establish()
+                conn.send('welcome')
+
+        self.server = Server('127.0.0.1', free_port(), max_pending=1, auth_timeout=1)
+        self.server.set_request_handler(handler)
+        start_server(self.server)
+
+        with socket.create_connection(('127.0.0.1', self.server.port)) as idle:
+            idle.settimeout(5)
+            self.assertEqual(idle.recv(2048), b'200: Success\r\n' + FRAME_END)
+
+            # the only pending slot is taken by the client which hasn't signed in.
+            with socket.create_connection(('127.0.0.1', self.server.port)) as s:
+                s.settimeout(5)
+                self.assertEqual(s.recv(2048), b'503: Too many pending connections\r\n' +
+                                 FRAME_END)
+
+            # then it's stopped after the timeout.
+            self.assertEqual(idle.recv(2048), b'200: Close the connection\r\n' + FRAME_END)
+            self.assertTrue(wait_until(lambda: self.server.connection_count == 0))
+            self.assertEqual(self.server.pending_count, 0)
+
+        with socket.create_connection(('127.0.0.1', self.server.port)) as s:
+            s.settimeout(5)
+            s.recv(2048)
+            s.sendall(b'sign_in' + FRAME_END)
+            self.assertEqual(s.recv(2048), b'welcome' + FRAME_END)
+            self.assertEqual(self.server.pending_count, 0)
+
+            # the established connection stays after the timeout.
+            time.sleep(1.5)
+            self.assertEqual(self.server.connection_count, 1)
+
+
+class CommandTimerTest(unittest.TestCase):
+    def test_record_and_report(self):
+        timer = CommandTimer()
+        timer.record('msg_in', 0.002)
+        timer.record('msg_in', 0.004)
+        timer.record('auth_res', 0.010)
+
+        self.assertEqual(timer.stats['msg_in'][0], 2)
+        self.assertAlmostEqual(timer.stats['msg_in'][1], 0.006)
+        self.assertAlmostEqual(timer.stats['msg_in'][2], 0.004)
+
+        # the most total time first.
+        lines = timer.report().split('\n')
+        self.assertEqual([line.split()[0] for line in lines[1:]], ['auth_res', 'msg_in'])
+
+        timer.reset()
+        self.assertEqual(timer.stats, dict())
+
+    def test_unknown_commands_are_grouped(self):
+        timer = CommandTimer()
+        timer.add_commands(['msg_in'])
+        for i in range(100):
+            timer.record(f'garbage{i}', 0.001)
+        timer.record('msg_in', 0.001)
+
+        self.assertEqual(sorted(timer.stats), [CommandTimer.OTHER, 'msg_in'])
+        self.assertEqual(timer.stats[CommandTimer.OTHER][0], 100)
+
+    def test_commands_are_capped(self):
+        timer = CommandTimer(max_commands=10)
+        for i in range(100):
+            timer.record(f'garbage{i}', 0.001)
+
+        self.assertEqual(len(timer.stats), 11)
+        self.assertEqual(timer.stats[CommandTimer.OTHER][0], 90)
+
+
+class AdminTest(unittest.TestCase):
+    def setUp(self):
+        self.profile_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.profile_dir)
+        self.server = Server('127.0.0.1', 0, profile_dir=self.profile_dir)
+
+    def tearDown(self):
+        if self.server.profiler is not None:
+            self.server.profiler.stop()
+
+    def test_prof_dump_stays_in_the_profile_dir(self):
+        self.server.admin_command('prof start')
+        self.server.admin_command('prof stop')
+
+        for file_name in ('../escaped.folded', '/tmp/escaped.folded', '.hidden', 'a/b'):
+            self.assertIn('can only have', self.server.admin_command(f'prof dump {file_name}'))
+        self.assertEqual(os.listdir(self.profile_dir), [])
+
+        self.assertIn('written', self.server.admin_command('prof dump run-1.folded'))
+        self.assertEqual(os.listdir(self.profile_dir), ['run-1.folded'])
+
+
+class AdminConsoleTest(unittest.TestCase):
+    def setUp(self):
+        self.profile_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.profile_dir)
+
+        self.server = Server('127.0.0.1', free_port(), admin_port=free_port(),
+                             profile_dir=self.profile_dir)
+        self.server.set_request_handler(greeting_handler)
+        self.server.command_timer.add_commands(['200: Success', 'ping', 'bye'])
+        start_server(self.server)
+
+        # a client which has sent a command.
+        self.client = socket.create_connection(('127.0.0.1', self.server.port))
+        self.client.settimeout(5)
+        self.client.recv(2048)
+        self.client.sendall(b'200: Success\r\n' + FRAME_END + b'ping' + FRAME_END)
+        data = b''
+        while data.count(FRAME_END) < 2:
+            data += self.client.recv(2048)
+
+    def tearDown(self):
+        self.client.close()
+        if self.server.profiler is not None:
+            self.server.profiler.stop()
+        self.server.stop()
+
+    def admin(self, line):
+        # run a command on the admin port, the output is read until it closes.
+        with socket.create_connection(('127.0.0.1', self.server.admin_port)) as s:
+            s.settimeout(5)
+            s.sendall(line.encode('utf-8') + b'\n')
+            s.shutdown(socket.SHUT_WR)
+
+            data = b''
+            while True:
+                chunk = s.recv(4096)
+                if chunk == b'':
+                    return data.decode('utf-8')
+                data += chunk
+
+    def test_help(self):
+        commands = [line.split()[0] for line in self.admin('help').splitlines()]
+        self.assertEqual(commands, ['qt', 'help', 'prof', 'cmds', 'slow', 'queues',
+                                    'admission'])
+        self.assertIn('Unknown command nothing', self.admin('nothing'))
+
+    def test_cmds(self):
+        lines = self.admin('cmds').splitlines()
+        self.assertEqual(lines[0].split()[0], 'command')
+        self.assertEqual(sorted(line.split()[0] for line in lines[1:]), ['200:', 'ping'])
+        self.assertEqual(self.server.command_timer.stats['ping'][0], 1)
+
+        self.assertIn('reset', self.admin('cmds reset'))
+        self.assertEqual(self.admin('cmds').splitlines()[1:], [])
+
+    def test_connections(self):
+        slow = self.admin('slow').splitlines()
+        self.assertEqual(len(slow), 3)
+        self.assertEqual(slow[1].split()[1], '2')  # the accept message and ping.
+        self.assertEqual(slow[2], '1 connections in total.')
+
+        queues = self.admin('queues').splitlines()
+        self.assertEqual(queues[1].split()[1], '0')
+
+        admission = self.admin('admission').splitlines()
+        self.assertEqual(admission[0], 'connections: 1 / unlimited')
+        self.assertEqual(admission[-1].split(), ['127.0.0.1', '1'])
+
+    def test_profiler(self):
+        self.assertIn('never been started', self.admin('prof stop'))
+        self.assertIn('started', self.admin('prof start 1'))
+        self.assertIn('already running', self.admin('prof start'))
+        self.assertTrue(wait_until(lambda: self.server.profiler.samples >= 5))
+        self.assertIn('stopped', self.admin('prof stop'))
+
+        self.assertIn('written', self.admin('prof dump stacks.folded'))
+        with open(os.path.join(self.profile_dir, 'stacks.folded')) as f:
+            lines = f.read().splitlines()
+
+        # "file:function;file:function;... count", the outermost frame first.
+        self.assertTrue(lines)
+        for line in lines:
+            stack, count = line.rsplit(' ', 1)
+            self.assertGreater(int(count), 0)
+            self.assertTrue(all(':' in frame for frame in stack.split(';')))
+        self.assertTrue(any('takumi_connection.py:run;takumi_connection.py:serve' in line
+                            for line in lines))
+
+
+class HighDescriptorTest(unittest.TestCase):
+    def setUp(self):
+        self.server = None
+        self.held = []
+
+        # push the next descriptors past FD_SETSIZE. (usually 1024)
+        try:
+            import resource
+        except ImportError:
+            raise unittest.SkipTest('resource is needed to raise the file limit.')
+
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if soft < 1200:
+            if hard != resource.RLIM_INFINITY and hard < 1200:
+                raise unittest.SkipTest('the file limit is too low.')
+            resource.setrlimit(resource.RLIMIT_NOFILE, (1200, hard))
+            self.addCleanup(resource.setrlimit, resource.RLIMIT_NOFILE, (soft, hard))
+
+    def tearDown(self):
+        if self.server is not None and self.server.is_running:
+            self.server.stop()
+        for fd in self.held:
+            os.close(fd)
+
+    def test_descriptors_above_fd_setsize(self):
+        self.server = Server('127.0.0.1', free_port())
+        self.server.set_request_handler(greeting_handler)
+        start_server(self.server)
+
+        while len(self.held) < 1100:
+            self.held.append(os.open(os.devnull, os.O_RDONLY))
+
+        with socket.create_connection(('127.0.0.1', self.server.port)) as s:
+            s.settimeout(5)
+            self.assertEqual(s.recv(2048), b'200: Success\r\n' + FRAME_END)
+
+            s.sendall(b'200: Success\r\n' + FRAME_END)
+            self.assertEqual(s.recv(2048), b'hello' + FRAME_END)
+
+
+class TLSTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        if shutil.which('openssl') is None:
+            raise unittest.SkipTest('openssl is needed to make the certificate.')
+
+        cls.cert_dir = tempfile.mkdtemp()
+        cls.certfile = os.path.join(cls.cert_dir, 'cert.pem')
+        cls.keyfile = os.path.join(cls.cert_dir, 'key.pem')
+        subprocess.run(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes',
+                        '-days', '1', '-subj', '/CN=127.0.0.1',
+                        '-addext', 'subjectAltName=IP:127.0.0.1',
+                        '-keyout', cls.keyfile, '-out', cls.certfile],
+                       check=True, capture_output=True)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.cert_dir)
+
+    def setUp(self):
+        self.server = Server('127.0.0.1', free_port(),
+                             ssl_context=create_server_ssl_context(self.certfile,
+                                                                   self.keyfile),
+                             handshake_timeout=2)
+        self.server.set_request_handler(greeting_handler)
+        start_server(self.server)
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_reconnect_resumes_the_session(self):
+        client = Client('127.0.0.1', self.server.port,
+                        ssl_context=create_client_ssl_context(self.certfile))
+        received = []
+
+        def handler(recv, conn):
+            received.append((recv[0], conn.socket.session_reused))
+            conn.send('bye')
+
+        client.set_response_handler(handler)
+        client.run()
+        client.run()
+
+        self.assertEqual(received, [('hello', False), ('hello', True)])
+
+    def test_client_handshake_times_out(self):
+        # a server which accepts the TCP connection, but never answers.
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as silent:
+            silent.bind(('127.0.0.1', 0))
+            silent.listen()
+
+            client = Client('127.0.0.1', silent.getsockname()[1],
+                            ssl_context=create_client_ssl_context(self.certfile),
+                            connect_timeout=0.5)
+            client.set_response_handler(greeting_handler)
+
+            started = time.time()
+            with self.assertRaises(Exception):
+                client.run()
+            self.assertLess(time.time() - started, 3)
+            self.assertEqual(client.socket.fileno(), -1)
+
+    def test_idle_clients_dont_block_the_handshake(self):
+        # the clients which never start the handshake only hold their own
+        # connection threads.
+        idle = [socket.create_connection(('127.0.0.1', self.server.port))
+                for _ in range(8)]
+        try:
+            context = create_client_ssl_context(self.certfile)
+            started = time.time()
+            with socket.create_connection(('127.0.0.1', self.server.port)) as s:
+                with context.wrap_socket(s, server_hostname='127.0.0.1') as tls:
+                    tls.settimeout(5)
+                    self.assertEqual(tls.recv(2048), b'200: Success\r\n' + FRAME_END)
+            self.assertLess(time.time() - started, self.server.handshake_timeout)
+        finally:
+            for s in idle:
+                s.close()
+
+if __name__ == '__main__':
+    unittest.main()
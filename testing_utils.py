@@ -0,0 +1,26 @@
+#!/usr/bin/python3
+# testing_utils.py
+# the helpers shared by the tests.
+
+from threading import Thread
+import socket
+import time
+
+
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def wait_until(condition, timeout=5):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if condition():
+            return True
+        time.sleep(0.05)
+    return False
+
+def start_server(server):
+    Thread(target=server.run, daemon=True).start()
+    if not wait_until(lambda: server.is_running):
+        raise Exception('The server didn\'t start.')